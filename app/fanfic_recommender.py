@@ -14,14 +14,15 @@ import re
 from wordcloud import WordCloud
 import matplotlib.pyplot as plt
 from PIL import Image
-from gensim.test.utils import get_tmpfile
-from gensim.similarities import Similarity
 import pickle
 import sys
 import numpy as np
 sys.path.append("..")
 from util.preprocess import process_text
 from util.scrape import scrape_fic
+from util.resources import registry
+from util.index_bundle import load_index_bundle
+from util.recommend import Recommender, to_vector
 
 from collections import Counter
 st.beta_set_page_config(layout="wide")
@@ -31,18 +32,19 @@ from streamlit.report_thread import get_report_ctx
 @st.cache(allow_output_mutation=True)
 def init():
     stopwords = pickle.load(open("../stopwords.pickle", "rb"))
-    fic_info = pickle.load(open("../data/fic_info.pickle", "rb"))
-    model_info = pickle.load(open("../models/avatar_model.pickle", "rb"))
-
-    model = model_info["model"]
-    dictionary = model_info["dict"]
-    corpus = model_info["corpus"]
-    index = Similarity.load("../models/sim_index.pickle")
-    index_temp = get_tmpfile("index")
-    index = Similarity(index_temp, model[corpus], num_features = model.num_topics)
-    index.save("similarity_index.pickle")
+    # built offline with util.index_bundle.build_index_bundle
+    bundle = load_index_bundle("../models/index_bundle")
+
+    model = bundle["model"]
+    dictionary = bundle["dictionary"]
+    fic_info = bundle["fic_info"]
+    # topic vectors of every fic, normalized for cosine similarity
+    index = Recommender(bundle["vectors"], [info["work_id"] for info in fic_info])
     # todo: save words as frequencies to save time/space
 
+    # load the preprocessing resources now instead of on the first favorite
+    registry.warm_up(["stopwords", "wordnet_lemmatizer"])
+
     return {"fic_list": [], "model": model, "dictionary": dictionary, "index": index, "fic_topics": [], "words": "", "recs": [], "fic_info": fic_info, "clicked_rec": False, "stopwords": stopwords, "show_wc": False}
 
 ctx = get_report_ctx()
@@ -59,12 +61,8 @@ def get_topics_and_words(doc):
     return topics, ' '.join(doc_pro)
 
 def get_recs(favorites_topics, top_n = 5):
-    sims = np.zeros(len(cache["index"]))
-    for similarities in cache["index"][favorites_topics]:
-        sims += similarities
-
-    best_idx = np.argsort(sims)[::-1][:top_n]
-    best_sim = sims[best_idx]
+    favorites = [to_vector(topics, cache["model"].num_topics) for topics in favorites_topics]
+    best_idx = cache["index"].recommend(favorites, top_n)
 
     return best_idx
 
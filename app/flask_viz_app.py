@@ -9,9 +9,14 @@ import numpy as np
 import pandas as pd
 import pickle
 from flask import Flask, request, render_template, abort, jsonify
-import spacy
 import itertools
+import sys
+sys.path.append("..")
 from util.analytics import char_freq, pair_freq, get_overlap_sentences, get_sentiments, alone_time, process_helper
+from util.resources import registry
+
+# Load spaCy and VADER once at startup rather than on each request
+registry.warm_up(["spacy_en", "vader"])
 
 # Initialize the app
 app = flask.Flask(__name__)
@@ -35,7 +40,7 @@ def process_text():
     data = flask.request.json
     text = data["text"]
 
-    nlp = spacy.load('en_core_web_sm')
+    nlp = registry.get("spacy_en")
     doc = nlp(text)
 
     gaang = ["Aang", "Sokka", "Zuko", "Katara", "Toph"]
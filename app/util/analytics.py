@@ -4,9 +4,9 @@
 #
 #
 
-from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 import itertools
 from collections import Counter
+from util.resources import registry
 
 # Allows our flask app to pass in a SpaCy-processed document and a list of
 # characters; will search for character and character-pair frequencies and
@@ -163,7 +163,7 @@ def merge_spans(doc, spans):
     return merge_spans
 
 def get_sentiments(sentences):
-    analyzer = SentimentIntensityAnalyzer()
+    analyzer = registry.get("vader")
     scores = []
     for sentence in sentences:
         vs = analyzer.polarity_scores(sentence)
@@ -0,0 +1,44 @@
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+# the tests import util.* the same way the notebooks and app do
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+
+@pytest.fixture
+def server():
+    '''
+    A local HTTP server. Each GET is answered by server.respond(path,
+    headers), which returns (status, headers, body), and recorded in
+    server.requests as (time, path, headers).
+    '''
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with httpd.lock:
+                httpd.requests.append((time.monotonic(), self.path, dict(self.headers)))
+                status, headers, body = httpd.respond(self.path, self.headers)
+            body = body.encode("utf-8") if isinstance(body, str) else body
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.lock = threading.Lock()
+    httpd.requests = []
+    httpd.respond = lambda path, headers: (200, {}, "ok")
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
@@ -0,0 +1,72 @@
+'''
+A stand-in for AO3's search and work pages, served by the server fixture.
+'''
+
+import os
+from datetime import date, timedelta
+from urllib.parse import parse_qs, urlparse
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+BLURB = '''
+<li id="work_{work_id}" class="work blurb group" role="article">
+  <div class="header module">
+    <h4 class="heading"><a href="/works/{work_id}">Work {work_id}</a> by <a rel="author" href="/users/a{work_id}/pseuds/a{work_id}">a{work_id}</a></h4>
+    <ul class="required-tags"><li><a><span class="rating-teen rating"><span class="text">Teen</span></span></a></li></ul>
+    <p class="datetime">{date}</p>
+  </div>
+  <dl class="stats">
+    <dt class="language">Language:</dt><dd class="language">English</dd>
+    <dt class="words">Words:</dt><dd class="words">{words}</dd>
+    <dt class="chapters">Chapters:</dt><dd class="chapters">{chapters}/?</dd>
+  </dl>
+</li>
+'''
+
+
+class FakeAO3():
+    '''
+    {n_works} works, work i posted i days before the newest and not revised
+    since, listed {per_page} to a search page in the order the search asks
+    for. Change self.works to post, revise or delete works.
+    '''
+    def __init__(self, n_works=30, per_page=20):
+        newest = date(2020, 12, 31)
+        self.per_page = per_page
+        self.works = [{"work_id": str(i), "created": newest - timedelta(days=i), "revised": newest - timedelta(days=i), "chapters": 1} for i in range(1, n_works + 1)]
+        with open(os.path.join(FIXTURES, "work.html"), "r", encoding="utf-8") as f:
+            self.work_page = f.read()
+
+    def post(self, n_works):
+        newest = max(work["created"] for work in self.works)
+        first_id = max(int(work["work_id"]) for work in self.works) + 1
+        for i in range(n_works):
+            posted = newest + timedelta(days=i + 1)
+            self.works.append({"work_id": str(first_id + i), "created": posted, "revised": posted, "chapters": 1})
+
+    def revise(self, work_id, revised):
+        for work in self.works:
+            if work["work_id"] == work_id:
+                work["revised"] = revised
+                work["chapters"] += 1
+
+    def delete(self, work_id):
+        self.works = [work for work in self.works if work["work_id"] != work_id]
+
+    def search_page(self, query):
+        column = query.get("work_search[sort_column]", ["created_at"])[0]
+        key = "revised" if column == "revised_at" else "created"
+        works = sorted(self.works, key=lambda work: work[key], reverse=True)
+        page = int(query.get("page", ["1"])[0])
+        on_page = works[(page - 1) * self.per_page:page * self.per_page]
+        blurbs = "".join(BLURB.format(work_id=work["work_id"], date=work["revised"].strftime("%d %b %Y"), words=1000, chapters=work["chapters"]) for work in on_page)
+        return f'<html><body><h3 class="heading">{len(works)} Found</h3><ol class="work index group">{blurbs}</ol></body></html>'
+
+    def respond(self, path, headers):
+        url = urlparse(path)
+        if url.path == "/works/search":
+            return 200, {}, self.search_page(parse_qs(url.query))
+        work_id = url.path.split("/")[2]
+        if any(work["work_id"] == work_id for work in self.works):
+            return 200, {}, self.work_page
+        return 404, {}, "not found"
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from util.ann import ExactIndex, IVFPQIndex
+
+
+def make_vectors(n, dim=12, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.dirichlet(np.full(dim, 0.3), n).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_reranked_search_matches_exact():
+    vectors = make_vectors(2000)
+    exact = ExactIndex(12)
+    exact.add(np.arange(2000), vectors)
+    index = IVFPQIndex(12, n_lists=16, n_probe=16, n_bits=6)
+    for start in range(0, 2000, 100):
+        index.add(np.arange(start, start + 100), vectors[start:start+100])
+
+    for query in vectors[:20]:
+        _, scores = index.search(query, 5)
+        _, exact_scores = exact.search(query, 5)
+        assert scores == pytest.approx(exact_scores, abs=1e-5)
+
+
+def test_compact_frees_rows_for_reuse():
+    vectors = make_vectors(600)
+    index = IVFPQIndex(12, n_lists=8, n_bits=4)
+    index.add(np.arange(300), vectors[:300])
+    capacity = len(index.vectors)
+
+    index.remove(list(range(200)))
+    index.compact()
+    index.add(np.arange(300, 500), vectors[300:500])
+    # re-adding an id replaces its vector in place of the old one
+    index.add([250], vectors[500:501])
+
+    assert len(index) == 300
+    assert len(index.vectors) == capacity
+    ids, scores = index.search(vectors[500], 1, n_probe=8)
+    assert ids.tolist() == [250]
+    assert scores[0] == pytest.approx(1.0, abs=1e-5)
+
+
+def test_rerank_without_raw_vectors_raises():
+    vectors = make_vectors(200)
+    index = IVFPQIndex(12, n_lists=4, n_bits=4, rerank=0)
+    index.add(np.arange(200), vectors)
+
+    assert len(index.search(vectors[0], 3)[0]) == 3
+    with pytest.raises(ValueError):
+        index.search(vectors[0], 3, rerank=4)
@@ -0,0 +1,67 @@
+import os
+import pytest
+
+pytest.importorskip("bs4")
+pytest.importorskip("requests")
+from util import scrape
+from util.chapters import ChapterStreamParser, iter_chapters
+from util.fetch import Fetcher
+from util.scrape import parse_fic_page
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+@pytest.fixture(scope="module")
+def html():
+    with open(os.path.join(FIXTURES, "work.html"), "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def parse_chunks(chunks):
+    parser = ChapterStreamParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    parser.close()
+    return list(parser.ready)
+
+
+def split_at(html, cuts):
+    bounds = [0] + sorted(cuts) + [len(html)]
+    return [html[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def test_chapters_join_to_parsed_text(html):
+    chapters = parse_chunks([html])
+    assert [chapter["index"] for chapter in chapters] == [1, 2]
+    assert ' '.join(chapter["text"] for chapter in chapters) == parse_fic_page(html)["text"]
+    assert chapters[0]["paragraphs"] == 2
+    assert chapters[1]["words"] == len(chapters[1]["text"].split())
+
+
+def test_every_chunk_boundary_gives_the_same_chapters(html):
+    expected = parse_chunks([html])
+    start = html.index('<div id="chapters"')
+    end = html.index("</html>")
+    # one cut at every offset in the chapters, so some land inside tags,
+    # attribute values and the &nbsp; and &amp; entities
+    for cut in range(start, end):
+        assert parse_chunks(split_at(html, [cut])) == expected, cut
+
+
+@pytest.mark.parametrize("needle", ["&nbsp;", "&amp;", '<p>He', '<div class="chapter" id="chapter-2">', "</p>", "<br>"])
+def test_cuts_inside_tags_and_entities(html, needle):
+    expected = parse_chunks([html])
+    at = html.index(needle, html.index('<div id="chapters"'))
+    # cut after every character of the tag or entity at once
+    assert parse_chunks(split_at(html, list(range(at + 1, at + len(needle))))) == expected
+
+
+# byte-sized chunks also split the multibyte quotes in chapter 2
+@pytest.mark.parametrize("chunk_size", [1, 3, 17, 256])
+def test_streamed_page_matches_parsed_text(server, monkeypatch, html, chunk_size):
+    server.respond = lambda path, headers: (200, {"Content-Type": "text/html; charset=utf-8"}, html)
+    monkeypatch.setattr(scrape, "base_url", server.url)
+
+    chapters = list(iter_chapters("1", fetcher=Fetcher(rate=1000), chunk_size=chunk_size))
+    assert [chapter["work_id"] for chapter in chapters] == ["1", "1"]
+    assert ' '.join(chapter["text"] for chapter in chapters) == parse_fic_page(html)["text"]
@@ -0,0 +1,28 @@
+import random
+import pytest
+
+pytest.importorskip("gensim")
+from gensim.corpora import Dictionary
+from gensim.models import CoherenceModel
+from util.coherence import CoherenceEvaluator
+
+
+def make_docs(doc_lens, n_docs=80, vocab_size=60, seed=0):
+    rng = random.Random(seed)
+    vocab = [f"w{i}" for i in range(vocab_size)]
+    # documents draw from vocabularies of different sizes, so words co-occur unevenly
+    return [[rng.choice(vocab[:rng.randint(10, vocab_size)]) for _ in range(rng.randint(*doc_lens))] for _ in range(n_docs)]
+
+
+@pytest.mark.parametrize("doc_lens, window_size", [((5, 100), 110), ((120, 400), 110), ((20, 80), 10)])
+def test_matches_gensim_c_v(doc_lens, window_size):
+    docs = make_docs(doc_lens)
+    dictionary = Dictionary(docs)
+    rng = random.Random(1)
+    topics = [rng.sample(sorted(dictionary.token2id), 8) for _ in range(4)]
+
+    expected = CoherenceModel(topics=topics, texts=docs, dictionary=dictionary, coherence="c_v", window_size=window_size, processes=1).get_coherence_per_topic()
+    evaluator = CoherenceEvaluator(docs, window_size=window_size)
+    assert evaluator.score_topics(topics, per_topic=True) == pytest.approx(expected)
+    # and the same when counted in a process pool
+    assert CoherenceEvaluator(docs, window_size=window_size, n_jobs=2).score_topics(topics) == pytest.approx(sum(expected) / len(expected))
@@ -0,0 +1,43 @@
+import random
+import pytest
+
+pytest.importorskip("gensim")
+from gensim.corpora import Dictionary
+from util.corpus import TokenCorpus
+
+
+def random_docs(seed, n_docs=60, vocab_size=80):
+    rng = random.Random(seed)
+    vocab = [f"w{i}" for i in range(vocab_size)]
+    # skewed so filter_extremes drops words at both ends
+    weights = [1 / (i + 1) for i in range(vocab_size)]
+    docs = [rng.choices(vocab, weights, k=rng.randint(0, 40)) for _ in range(n_docs)]
+    docs[3] = []
+    return docs
+
+
+@pytest.mark.parametrize("filter_kwargs", [None, {"no_below": 3, "no_above": 0.5}, {"no_below": 1, "no_above": 1.0, "keep_n": 10}])
+def test_matches_gensim_dictionary_and_doc2bow(tmp_path, filter_kwargs):
+    docs = random_docs(0)
+    corpus = TokenCorpus.build(docs, str(tmp_path))
+    assert list(corpus) == docs
+
+    expected = Dictionary(docs)
+    # small blocks so documents are counted across several of them
+    dictionary = corpus.to_dictionary(block_size=7)
+    assert dictionary.token2id == expected.token2id
+    assert dictionary.cfs == expected.cfs
+    assert dictionary.dfs == expected.dfs
+    assert (dictionary.num_docs, dictionary.num_pos, dictionary.num_nnz) == (expected.num_docs, expected.num_pos, expected.num_nnz)
+
+    if filter_kwargs is not None:
+        expected.filter_extremes(**filter_kwargs)
+        dictionary.filter_extremes(**filter_kwargs)
+        assert dictionary.token2id == expected.token2id
+        assert len(expected) < len(corpus.id2token)
+
+    bows = corpus.bow_corpus(dictionary)
+    assert len(bows) == len(docs)
+    assert list(bows) == [expected.doc2bow(doc) for doc in docs]
+    # re-iterable, as gensim's models expect
+    assert list(bows) == list(bows)
@@ -0,0 +1,66 @@
+import pytest
+
+requests = pytest.importorskip("requests")
+from util import fetch
+from util.fetch import Fetcher
+
+
+def scripted(server, script):
+    '''
+    Answer with the (status, headers) pairs in {script}, in order, then with
+    200s, and return the URL to fetch.
+    '''
+    script = list(script)
+    def respond(path, headers):
+        status, response_headers = script.pop(0) if script else (200, {})
+        return status, response_headers, "ok" if status == 200 else "slow down"
+    server.respond = respond
+    return server.url + "/works/1"
+
+
+def test_retry_after_is_honored(server):
+    url = scripted(server, [(429, {"Retry-After": "1"})])
+    fetcher = Fetcher(rate=50, backoff=0.01)
+
+    assert fetcher.get(url) == "ok"
+    times = [t for t, _, _ in server.requests]
+    assert len(times) == 2
+    assert times[1] - times[0] >= 0.95
+    # halved by the 429, then one success's worth of ramp-up
+    assert fetcher.get_limiter(url).rate == pytest.approx(25 + 5)
+
+
+def test_backs_off_until_retries_run_out(server, monkeypatch):
+    # take the top of each jittered backoff window
+    monkeypatch.setattr(fetch.random, "uniform", lambda low, high: high)
+    url = scripted(server, [(503, {})] * 3)
+    fetcher = Fetcher(rate=50, max_retries=2, backoff=0.1)
+
+    with pytest.raises(requests.HTTPError):
+        fetcher.get(url)
+    times = [t for t, _, _ in server.requests]
+    assert len(times) == 3
+    gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+    assert gaps[0] >= 0.1 and gaps[1] >= 0.2
+    assert fetcher.get_limiter(url).rate == pytest.approx(50 / 8)
+
+
+def test_rate_ramps_up_to_ceiling(server):
+    url = scripted(server, [])
+    fetcher = Fetcher(rate=20, max_rate=80)
+    for _ in range(10):
+        fetcher.get(url)
+    limiter = fetcher.get_limiter(url)
+    assert limiter.rate == pytest.approx(20 + 10 * 2)
+
+    for _ in range(40):
+        fetcher.get(url)
+    assert limiter.rate == pytest.approx(limiter.max_rate) == pytest.approx(80)
+
+
+def test_no_ramp_by_default(server):
+    url = scripted(server, [])
+    fetcher = Fetcher(rate=20)
+    for _ in range(5):
+        fetcher.get(url)
+    assert fetcher.get_limiter(url).rate == 20
@@ -0,0 +1,105 @@
+import os
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip("requests")
+from util import http_cache
+from util.fetch import Fetcher
+from util.http_cache import CacheMissError, ResponseCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    '''
+    The cache's clock, advanced by hand.
+    '''
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(http_cache, "time", SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+@pytest.fixture
+def site(server):
+    '''
+    Serves a distinct, incompressible page at every path, with an ETag, and
+    answers a matching If-None-Match with 304.
+    '''
+    pages = {}
+    def respond(path, headers):
+        body = pages.setdefault(path, os.urandom(600).hex())
+        etag = f'"{hash(body)}"'
+        if headers.get("If-None-Match") == etag:
+            return 304, {"ETag": etag}, b""
+        return 200, {"ETag": etag}, body
+    server.respond = respond
+    server.pages = pages
+    return server
+
+
+def paths(server):
+    return [path for _, path, _ in server.requests]
+
+
+def test_stale_entry_is_revalidated_with_304(site, tmp_path, clock):
+    cache = ResponseCache(str(tmp_path), ttl=60)
+    fetcher = Fetcher(rate=1000, cache=cache)
+    body = fetcher.get(site.url + "/works/1")
+
+    clock.now += 61
+    assert fetcher.get(site.url + "/works/1") == body
+    assert len(site.requests) == 2
+    assert site.requests[1][2]["If-None-Match"] == cache.lookup(site.url + "/works/1")["etag"]
+    assert cache.stats()["revalidated"] == 1
+
+    # revalidating counts as a fresh fetch
+    clock.now += 30
+    assert fetcher.get(site.url + "/works/1") == body
+    assert len(site.requests) == 2
+
+
+def test_fresh_entry_is_served_without_a_request(site, tmp_path, clock):
+    cache = ResponseCache(str(tmp_path), ttl=60)
+    fetcher = Fetcher(rate=1000, cache=cache)
+    body = fetcher.get(site.url + "/works/1")
+
+    clock.now += 59
+    assert fetcher.get(site.url + "/works/1") == body
+    assert paths(site) == ["/works/1"]
+    assert cache.stats()["hits"] == 1
+
+    # entries never expire without a ttl, even across instances
+    clock.now += 10 ** 6
+    assert Fetcher(rate=1000, cache=ResponseCache(str(tmp_path))).get(site.url + "/works/1") == body
+    assert paths(site) == ["/works/1"]
+
+
+def test_least_recently_used_entries_are_evicted(site, tmp_path, clock):
+    cache = ResponseCache(str(tmp_path))
+    fetcher = Fetcher(rate=1000, cache=cache)
+    for path in ("/works/1", "/works/2"):
+        fetcher.get(site.url + path)
+        clock.now += 1
+    # room for two entries, not three
+    cache.max_bytes = cache.stats()["bytes"] + 100
+
+    fetcher.get(site.url + "/works/1")
+    clock.now += 1
+    fetcher.get(site.url + "/works/3")
+
+    assert cache.lookup(site.url + "/works/2") is None
+    assert cache.lookup(site.url + "/works/1") is not None
+    assert cache.lookup(site.url + "/works/3") is not None
+    assert cache.stats()["entries"] == 2
+    assert sorted(os.listdir(tmp_path)) == sorted(ResponseCache.get_key(site.url + path) + ext for path in ("/works/1", "/works/3") for ext in (".gz", ".json"))
+
+
+def test_offline_serves_cache_and_raises_on_miss(site, tmp_path):
+    fetcher = Fetcher(rate=1000, cache=ResponseCache(str(tmp_path), ttl=0))
+    body = fetcher.get(site.url + "/works/1")
+
+    offline = Fetcher(rate=1000, cache=ResponseCache(str(tmp_path), ttl=0, offline=True))
+    # stale, but never revalidated offline
+    assert offline.get(site.url + "/works/1") == body
+    with pytest.raises(CacheMissError):
+        offline.get(site.url + "/works/2")
+    assert paths(site) == ["/works/1"]
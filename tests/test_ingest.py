@@ -0,0 +1,39 @@
+from datetime import date
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("bs4")
+import pandas as pd
+from util import scrape
+from util.fetch import Fetcher
+from util.ingest import ingest_updates
+from fake_ao3 import FakeAO3
+
+
+@pytest.fixture
+def ao3(server, monkeypatch):
+    site = FakeAO3(n_works=30, per_page=20)
+    server.respond = site.respond
+    monkeypatch.setattr(scrape, "base_url", server.url)
+    return site
+
+
+def test_ingest_picks_up_older_work_with_new_chapter(ao3, tmp_path):
+    search_url = scrape.get_search_url("Avatar: The Last Airbender")
+    fetcher = Fetcher(rate=1000)
+    empty = pd.DataFrame(columns=["work_id", "date", "chapters"])
+    stored_df, changelog = ingest_updates(search_url, empty, stop_after=5, fetcher=fetcher)
+    assert len(changelog["added"]) == 30
+
+    # an old work, far below the stop point by posting date, gains a chapter
+    ao3.revise("25", date(2021, 1, 5))
+    ao3.delete("3")
+    refreshed, changelog = ingest_updates(search_url, stored_df, stop_after=5, fetcher=fetcher, changelog_path=str(tmp_path / "changes.jsonl"))
+
+    assert changelog["updated"] == ["25"]
+    assert changelog["added"] == []
+    assert changelog["removed"] == ["3"]
+    assert changelog["stopped_early"]
+    assert refreshed["work_id"].tolist()[:2] == ["25", "1"]
+    assert len(refreshed) == 29
+    assert refreshed.set_index("work_id").loc["25", "chapters"] == 2
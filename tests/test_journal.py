@@ -0,0 +1,69 @@
+import os
+import pandas as pd
+import pytest
+
+from util.journal import ScrapeJournal
+
+
+def shard_names(directory):
+    return sorted(name for name in os.listdir(directory) if name.startswith("part-"))
+
+
+def test_torn_last_line_is_dropped_on_recovery(tmp_path):
+    journal = ScrapeJournal(str(tmp_path), shard_size=10)
+    for i in range(1, 4):
+        journal.append({"work_id": str(i), "title": f"Work {i}"})
+    # crash midway through writing the next record, leaving the shard open
+    journal.file.write('{"work_id": "4", "ti')
+    journal.file.flush()
+
+    recovered = ScrapeJournal(str(tmp_path), shard_size=10)
+    assert len(recovered) == 3
+    assert "3" in recovered and "4" not in recovered
+    assert shard_names(tmp_path) == ["part-00000.jsonl"]
+    assert ScrapeJournal.read_shard(str(tmp_path / "part-00000.jsonl"))[-1] == {"work_id": "3", "title": "Work 3"}
+
+    # new records go to a fresh shard rather than after the torn line
+    recovered.append({"work_id": "4", "title": "Work 4"})
+    recovered.close()
+    assert shard_names(tmp_path) == ["part-00000.jsonl", "part-00001.jsonl"]
+    assert recovered.to_dataframe()["work_id"].tolist() == ["1", "2", "3", "4"]
+
+
+def test_shards_compact_to_latest_record_per_work(tmp_path):
+    journal = ScrapeJournal(str(tmp_path), shard_size=2)
+    for i in range(1, 5):
+        journal.append({"work_id": str(i), "chapters": 1})
+    journal.append({"work_id": "2", "chapters": 2})
+    assert shard_names(tmp_path) == ["part-00000.jsonl", "part-00001.jsonl", "part-00002.jsonl.open"]
+
+    df = journal.compact(str(tmp_path / "works.pkl"))
+    assert shard_names(tmp_path) == ["part-00000.jsonl", "part-00001.jsonl", "part-00002.jsonl"]
+    assert df["work_id"].tolist() == ["1", "3", "4", "2"]
+    assert df.set_index("work_id").loc["2", "chapters"] == 2
+    pd.testing.assert_frame_equal(pd.read_pickle(tmp_path / "works.pkl"), df)
+
+
+def test_resumed_scrape_skips_journaled_works(server, monkeypatch, tmp_path):
+    pytest.importorskip("requests")
+    pytest.importorskip("bs4")
+    from util import scrape
+    from util.fetch import Fetcher
+    from fake_ao3 import FakeAO3
+
+    site = FakeAO3(n_works=8)
+    server.respond = site.respond
+    monkeypatch.setattr(scrape, "base_url", server.url)
+    info_list = [{"work_id": str(i)} for i in range(1, 9)]
+
+    journal = ScrapeJournal(str(tmp_path), shard_size=3)
+    scrape.scrape_fic_list(info_list[:5], workers=2, fetcher=Fetcher(rate=1000), journal=journal)
+    # a new process picks up from what reached the disk
+    server.requests.clear()
+    journal = ScrapeJournal(str(tmp_path), shard_size=3)
+    assert len(journal) == 5
+
+    df = scrape.scrape_fic_list(info_list, workers=2, fetcher=Fetcher(rate=1000), journal=journal)
+    assert sorted(path.split("?")[0] for _, path, _ in server.requests) == [f"/works/{i}" for i in range(6, 9)]
+    assert df["work_id"].tolist() == [str(i) for i in range(1, 9)]
+    assert df["title"].notna().all()
@@ -0,0 +1,97 @@
+import multiprocessing
+import random
+import numpy as np
+import pytest
+
+pytest.importorskip("gensim")
+from util.model import LDATuner, extend_vocabulary, load_version, update_model
+
+
+def make_docs(n_docs=40, doc_len=60, vocab_size=50, seed=0):
+    rng = random.Random(seed)
+    vocab = [f"w{i}" for i in range(vocab_size)]
+    return [[rng.choice(vocab) for _ in range(doc_len)] for _ in range(n_docs)]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_tune_hyper_parallel_matches_serial(monkeypatch, workers):
+    # gensim sizes its coherence pool from cpu_count; pretend to be multi-core
+    monkeypatch.setattr(multiprocessing, "cpu_count", lambda: 4)
+    keywords = ["num_topics", "min_thresh", "max_thresh", "alpha"]
+    param_grid = [(2, 1, 1.0, "symmetric"), (3, 1, 1.0, "symmetric")]
+
+    tuner = LDATuner(make_docs(), print_progress=False, verbose=False, workers=workers)
+    parallel = tuner.tune_hyper(keywords, param_grid, iterations=5, passes=1, n_jobs=2)
+    serial = LDATuner(make_docs(), print_progress=False, verbose=False, workers=workers).tune_hyper(keywords, param_grid, iterations=5, passes=1)
+
+    assert list(parallel) == param_grid
+    assert parallel == pytest.approx(serial)
+
+
+def test_tune_halving_perplexity_keeps_full_corpus():
+    tuner = LDATuner(make_docs(n_docs=50), print_progress=False, verbose=False)
+    keywords = ["num_topics", "min_thresh", "max_thresh"]
+    param_grid = [(2, 1, 1.0), (3, 1, 1.0), (4, 1, 1.0)]
+    scores, summary = tuner.tune_halving(keywords, param_grid, min_passes=1, max_passes=3, iterations=5, metric="perplexity", holdout=0.2)
+
+    assert set(scores) == set(param_grid)
+    assert summary["passes_trained"] < summary["full_grid_passes"]
+    assert len(tuner.corpus) == 50
+    assert tuner.get_doc_topics().shape == (50, tuner.model.num_topics)
+
+
+def test_tune_halving_perplexity_holds_out_at_least_one_doc():
+    tuner = LDATuner(make_docs(n_docs=9), print_progress=False, verbose=False)
+    keywords = ["num_topics", "min_thresh", "max_thresh"]
+    param_grid = [(2, 1, 1.0), (3, 1, 1.0)]
+    scores, summary = tuner.tune_halving(keywords, param_grid, min_passes=1, max_passes=2, reduction_factor=2, iterations=5, metric="perplexity", holdout=0.1)
+    assert all(np.isfinite(score) for score in scores.values())
+    assert summary["rounds"][-1]["candidates"] == 1
+
+    with pytest.raises(ValueError):
+        LDATuner(make_docs(n_docs=1), print_progress=False, verbose=False).tune_halving(keywords, param_grid, metric="perplexity")
+
+
+def test_update_model_extends_vocabulary_and_records_drift(tmp_path):
+    directory = str(tmp_path / "versions")
+    tuner = LDATuner(make_docs(), print_progress=False, verbose=False)
+    tuner.train_model(num_topics=3, iterations=20, passes=2)
+    base = tuner.save_model_version(directory)
+    num_terms = len(tuner.dictionary)
+
+    # two new tokens in enough documents to be added, one too rare
+    new_docs = make_docs(n_docs=10, seed=1)
+    for i, doc in enumerate(new_docs):
+        doc += ["fresh", "novel"] if i < 4 else []
+    new_docs[0].append("once")
+    model, dictionary, meta = update_model(directory, new_docs, min_df=3, passes=1, drift_threshold=10.0, max_update_fraction=0.5, print_progress=False)
+
+    assert (base["version"], meta["version"], meta["parent"]) == (1, 2, 1)
+    assert meta["kind"] == "update" and meta["new_docs"] == 10 and meta["new_tokens"] == 2
+    assert "fresh" in dictionary.token2id and "novel" in dictionary.token2id and "once" not in dictionary.token2id
+    assert len(dictionary) == num_terms + 2
+    assert model.eta.shape == model.state.eta.shape == (num_terms + 2,)
+    assert model.get_topics().shape == (3, num_terms + 2)
+    assert 0 < meta["drift"] <= meta["max_drift"] <= 1
+    assert not meta["needs_retrain"]
+
+    # the saved version reloads as returned, and drift adds up across updates
+    # until updates outnumber half the training documents
+    loaded, loaded_dictionary, loaded_meta = load_version(directory)
+    assert loaded_meta == meta
+    assert loaded.get_topics() == pytest.approx(model.get_topics())
+    assert loaded_dictionary.token2id == dictionary.token2id
+    _, _, second = update_model(directory, make_docs(n_docs=30, seed=2), passes=1, drift_threshold=10.0, max_update_fraction=0.5, print_progress=False)
+    assert (second["version"], second["parent"]) == (3, 2)
+    assert second["updated_docs"] == 40 and second["trained_docs"] == 40
+    assert second["drift_since_retrain"] == pytest.approx(meta["drift"] + second["drift"])
+    assert second["needs_retrain"]
+
+    # before any update, the learned prior keeps its values and is padded with its mean
+    base_model, base_dictionary, _ = load_version(directory, 1)
+    base_dictionary.add_documents([["fresh", "novel"]])
+    extend_vocabulary(base_model, base_dictionary)
+    assert base_model.eta[:num_terms] == pytest.approx(tuner.model.eta)
+    assert base_model.eta[num_terms:] == pytest.approx([tuner.model.eta.mean()] * 2)
+    assert base_model.state.sstats[:, num_terms:] == pytest.approx(np.zeros((3, 2)))
+    assert base_model.get_topics()[:, num_terms:].sum() > 0
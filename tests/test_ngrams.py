@@ -0,0 +1,66 @@
+import random
+from collections import Counter
+from util.ngrams import NgramCounter, NgramMatcher, merge_ngrams_naive
+
+# a small vocabulary, so configured phrases overlap and share prefixes often
+VOCAB = [f"w{i}" for i in range(8)]
+
+
+def random_config(rng):
+    phrase = lambda n: ' '.join(rng.choice(VOCAB) for _ in range(n))
+    return {
+        "bigrams": [phrase(2) for _ in range(rng.randint(0, 6))],
+        "trigrams": [phrase(3) for _ in range(rng.randint(0, 4))],
+        "exceptions": {phrase(rng.randint(1, 3)): f"x{i}" for i in range(rng.randint(0, 4))},
+    }
+
+
+def test_matcher_matches_naive():
+    # many small random configs in one test, rather than one test apiece
+    for seed in range(200):
+        rng = random.Random(seed)
+        ngrams = random_config(rng)
+        # configs may leave out any of the keys
+        for key in list(ngrams):
+            if rng.random() < 0.2:
+                del ngrams[key]
+        stop_after = rng.sample(VOCAB, rng.randint(0, 3))
+        matcher = NgramMatcher(ngrams)
+
+        for doc_len in (0, 1, 2, 3, rng.randint(4, 60)):
+            doc = [rng.choice(VOCAB) for _ in range(doc_len)]
+            assert matcher.merge(doc, stop_after) == merge_ngrams_naive(doc, ngrams, stop_after), f"seed {seed}"
+
+
+def count_two_pass(docs, stopwords):
+    # the original find_ngrams: bigrams, then trigrams, with no stopwords in them
+    c_bi = Counter()
+    for doc in docs:
+        for bigram in zip(doc, doc[1:]):
+            if not stopwords.intersection(bigram):
+                c_bi[bigram] += 1
+    c_tri = Counter()
+    for doc in docs:
+        for trigram in zip(doc, doc[1:], doc[2:]):
+            if not stopwords.intersection(trigram):
+                c_tri[trigram] += 1
+    return c_bi, c_tri
+
+
+def test_sharded_counter_matches_two_pass():
+    for seed in range(50):
+        rng = random.Random(seed)
+        stopwords = set(rng.sample(VOCAB, 2))
+        docs = [[rng.choice(VOCAB) for _ in range(rng.randint(0, 40))] for _ in range(rng.randint(1, 30))]
+
+        # split as find_ngrams does; each shard numbers tokens in its own order
+        n_shards = rng.randint(1, 5)
+        shard_size = max(1, -(-len(docs) // n_shards))
+        counter = NgramCounter(stopwords)
+        for start in range(0, len(docs), shard_size):
+            shard = NgramCounter(stopwords)
+            for doc in docs[start:start+shard_size]:
+                shard.add(doc)
+            counter.merge(shard)
+
+        assert counter.to_counters() == count_two_pass(docs, stopwords), f"seed {seed}"
@@ -0,0 +1,41 @@
+import os
+import pytest
+
+pytest.importorskip("bs4")
+pytest.importorskip("lxml")
+from util.scrape import parse_fic_page, parse_list_page
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), "r", encoding="utf-8") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("no_text", [False, True])
+def test_fic_page_backends_agree(no_text):
+    html = read_fixture("work.html")
+    parsed = parse_fic_page(html, no_text, backend="bs4")
+
+    assert parse_fic_page(html, no_text, backend="lxml") == parsed
+    assert parsed["title"] == "The Long Way Round"
+    assert parsed["all_authors"] == ["quill", "ink"]
+    assert parsed["series"] == {"part": "2", "name": "Roads Home"}
+    assert parsed["relationships"][1] == "Harry Potter & Luna Lovegood"
+    if no_text:
+        assert parsed["text"] == ""
+    else:
+        assert parsed["text"].startswith("It was a dark and stormy night & the owls")
+        assert "Not part of the text" not in parsed["text"]
+
+
+def test_list_page_backends_agree():
+    html = read_fixture("search.html")
+    num_found, works = parse_list_page(html, backend="bs4")
+
+    assert parse_list_page(html, backend="lxml") == (num_found, works)
+    assert num_found == "57"
+    assert [work["work_id"] for work in works] == ["12345", "67890"]
+    assert works[0]["words"] == 2345 and works[0]["rating"] == "teen"
+    assert works[1]["author"] == "Anonymous" and works[1]["series"] == {}
@@ -0,0 +1,58 @@
+import multiprocessing
+import random
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip("nltk")
+from util import preprocess
+from util.preprocess import LemmaCache, find_ngrams, process_texts
+from util.resources import registry
+
+
+class SuffixLemmatizer():
+    # stands in for WordNet, whose data may not be downloaded
+    def lemmatize(self, token, pos="n"):
+        return token[:-1] if pos == "n" and token.endswith("s") else token
+
+
+class FirstLetterTagger():
+    def tag(self, tokens):
+        return [(token, "VB" if token.startswith("v") else "NN") for token in tokens]
+
+
+@pytest.fixture
+def fake_nltk(monkeypatch):
+    if multiprocessing.get_start_method() != "fork":
+        pytest.skip("pool workers only inherit the fake resources when forked")
+    monkeypatch.setitem(registry.resources, "wordnet_lemmatizer", SuffixLemmatizer())
+    monkeypatch.setitem(registry.resources, "pos_tagger", FirstLetterTagger())
+    monkeypatch.setattr(preprocess, "word_tokenize", str.split)
+    monkeypatch.setattr(preprocess, "wordnet", SimpleNamespace(ADJ="a", VERB="v", NOUN="n", ADV="r"))
+
+
+def make_texts(n_docs=60, seed=0):
+    rng = random.Random(seed)
+    vocab = ["the", "cats", "dogs", "vows", "ran", "Harry", "Potters", "wands", "visits", "spells"]
+    return [" ".join(rng.choice(vocab) for _ in range(rng.randint(5, 200))) for _ in range(n_docs)]
+
+
+def test_parallel_matches_serial_and_merges_lemma_cache(fake_nltk):
+    texts = make_texts()
+    ngrams = {"bigrams": ["harry potter"]}
+    serial_cache, parallel_cache = LemmaCache(), LemmaCache()
+
+    serial = process_texts(texts, ngrams, custom_stop={"the"}, lemma_cache=serial_cache)
+    parallel = process_texts(texts, ngrams, custom_stop={"the"}, lemma_cache=parallel_cache, n_jobs=2, chunksize=3)
+
+    assert parallel == serial
+    assert dict(parallel_cache.lemmas) == dict(serial_cache.lemmas)
+    lookups = sum(len(text.split()) for text in texts)
+    assert parallel_cache.hits + parallel_cache.misses == lookups
+    assert parallel_cache.new_lemmas is None
+
+
+def test_parallel_find_ngrams_matches_serial(fake_nltk):
+    texts = make_texts()
+    serial = find_ngrams(texts, custom_stop={"the"})
+    assert find_ngrams(texts, custom_stop={"the"}, n_jobs=2) == serial
+    assert serial[0][("harry", "potters")] > 0
@@ -0,0 +1,46 @@
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("bs4")
+from util import scrape
+from util.fetch import Fetcher
+from util.scrape import WorkSearch, scrape_fic_list
+from fake_ao3 import FakeAO3
+
+
+class InterruptingFetcher(Fetcher):
+    # as if the user pressed Ctrl-C while work {interrupt_at} was downloading
+    def __init__(self, interrupt_at, **kwargs):
+        super().__init__(**kwargs)
+        self.interrupt_at = interrupt_at
+
+    def get(self, url):
+        if url.split("?")[0].endswith(f"/works/{self.interrupt_at}"):
+            raise KeyboardInterrupt
+        return super().get(url)
+
+
+@pytest.fixture
+def ao3(server, monkeypatch):
+    site = FakeAO3(n_works=12, per_page=5)
+    server.respond = site.respond
+    monkeypatch.setattr(scrape, "base_url", server.url)
+    return site
+
+
+def test_interrupted_scrape_resumes_without_skipping(ao3):
+    search_url = scrape.get_search_url("Avatar: The Last Airbender")
+    search = WorkSearch(search_url, fetcher=InterruptingFetcher("6", rate=1000, pool_size=2), print_every=0)
+    partial_df = scrape_fic_list(search, workers=2)
+
+    # works after 5 were fetched from the search ahead of time, but not scraped
+    assert partial_df["work_id"].tolist() == ["1", "2", "3", "4", "5"]
+    assert search.cursor == {"page": 1, "work_id": "5"}
+
+    # new postings push work 5 onto page 2
+    ao3.post(3)
+    resumed = WorkSearch(search_url, cursor=search.cursor, fetcher=Fetcher(rate=1000, pool_size=2), print_every=0)
+    full_df = scrape_fic_list(resumed, partial_df=partial_df, workers=2)
+
+    assert full_df["work_id"].tolist() == [str(i) for i in range(1, 13)]
+    assert resumed.cursor == {"page": 3, "work_id": "12"}
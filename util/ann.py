@@ -0,0 +1,268 @@
+'''
+# Nearest-neighbor indexes over unit topic vectors, for the recommender.
+#
+# Andrew Zhou
+#
+# ExactIndex scans every vector. IVFPQIndex clusters the vectors into lists
+# (inverted file) and compresses each one's residual from its list centroid
+# with product quantization, so a query only scores the lists nearest to it,
+# from small per-query lookup tables. Similarity is the inner product, i.e.
+# cosine for unit vectors.
+#
+# Sources of code and information:
+# https://lear.inrialpes.fr/pubs/2011/JDS11/jegou_searching_with_quantization.pdf
+'''
+
+import time
+import numpy as np
+from util.recommend import top_k
+
+
+def kmeans(vectors, n_clusters, iterations=20, seed=0):
+    '''
+    Lloyd's k-means, returning the centroids.
+    '''
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest(vectors, centroids)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        sums = np.stack([np.bincount(assignment, weights=vectors[:, d], minlength=n_clusters) for d in range(vectors.shape[1])], axis=1)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # restart empty clusters from random points
+        centroids[empty] = vectors[rng.choice(len(vectors), empty.sum())]
+    return centroids
+
+def nearest(vectors, centroids, batch_size=65536):
+    '''
+    Index of the closest (Euclidean) centroid to each vector.
+    '''
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), batch_size):
+        batch = vectors[start:start+batch_size]
+        assignment[start:start+batch_size] = np.argmin(centroid_norms - 2 * batch @ centroids.T, axis=1)
+    return assignment
+
+
+class ExactIndex():
+    '''
+    Brute-force inner-product search, the reference for IVFPQIndex.
+    '''
+    def __init__(self, dim):
+        self.dim = dim
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, ids, vectors):
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)])
+        self.vectors = np.vstack([self.vectors, np.asarray(vectors, dtype=np.float32)])
+
+    def remove(self, ids):
+        keep = ~np.isin(self.ids, ids)
+        self.ids, self.vectors = self.ids[keep], self.vectors[keep]
+
+    def search(self, query, k):
+        '''
+        The ids and scores of the k vectors with the highest inner product
+        with {query}, best first.
+        '''
+        scores = self.vectors @ np.asarray(query, dtype=np.float32)
+        best = top_k(scores, k)
+        return self.ids[best], scores[best]
+
+
+class IVFPQIndex():
+    '''
+    Inverted file index with product-quantized residuals.
+
+    train() learns {n_lists} coarse centroids and, for each of
+    {n_subvectors} slices of the dimensions, 2**{n_bits} residual
+    centroids. Each added vector is stored in its nearest list as one code
+    per slice. A search scores the {n_probe} lists closest to the query and,
+    if the raw vectors are kept ({rerank} > 0), rescores the best
+    k * {rerank} candidates exactly. Raising n_probe or rerank trades speed
+    for recall. Removed ids are skipped at search time until compact(), which
+    also frees their raw vectors' rows for reuse.
+    '''
+    def __init__(self, dim, n_lists=1024, n_subvectors=6, n_bits=8, n_probe=8, rerank=16, seed=0):
+        self.dim = dim
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.rerank = rerank
+        self.seed = seed
+        self.n_codes = 2 ** n_bits
+        self.slices = np.array_split(np.arange(dim), n_subvectors)
+        self.centroids = None
+        self.codebooks = None
+
+        self.list_ids = [np.zeros(0, dtype=np.int64) for _ in range(n_lists)]
+        self.list_codes = [np.zeros((0, n_subvectors), dtype=np.uint8 if n_bits <= 8 else np.uint16) for _ in range(n_lists)]
+        # id -> list, for removal, and id -> row of the raw vectors, for reranking
+        self.locations = {}
+        self.rows = {}
+        # raw vectors are only kept if the index is built to rerank; the array
+        # grows by doubling, and rows freed by compact() are reused
+        self.keep_vectors = bool(rerank)
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.n_rows = 0
+        self.free_rows = []
+        self.removed = set()
+
+    def __len__(self):
+        return len(self.locations) - len(self.removed)
+
+    def train(self, vectors, sample_size=100000):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        rng = np.random.default_rng(self.seed)
+        if len(vectors) > sample_size:
+            vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+        self.centroids = kmeans(vectors, self.n_lists, seed=self.seed)
+        self.n_lists = len(self.centroids)
+        residuals = vectors - self.centroids[nearest(vectors, self.centroids)]
+        self.codebooks = [kmeans(residuals[:, dims], self.n_codes, seed=self.seed) for dims in self.slices]
+        return self
+
+    def encode(self, residuals):
+        codes = np.empty((len(residuals), len(self.slices)), dtype=self.list_codes[0].dtype)
+        for m, dims in enumerate(self.slices):
+            codes[:, m] = nearest(residuals[:, dims], self.codebooks[m])
+        return codes
+
+    def add(self, ids, vectors):
+        '''
+        Insert vectors (training on them first if the index is untrained).
+        Re-adding an id replaces its vector.
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.centroids is None:
+            self.train(vectors)
+        self.remove([i for i in ids.tolist() if i in self.locations])
+        self.compact()
+
+        assignment = nearest(vectors, self.centroids)
+        codes = self.encode(vectors - self.centroids[assignment])
+        order = np.argsort(assignment, kind="stable")
+        bounds = np.searchsorted(assignment[order], np.arange(self.n_lists + 1))
+        for list_no in np.flatnonzero(np.diff(bounds)):
+            members = order[bounds[list_no]:bounds[list_no+1]]
+            self.list_ids[list_no] = np.concatenate([self.list_ids[list_no], ids[members]])
+            self.list_codes[list_no] = np.vstack([self.list_codes[list_no], codes[members]])
+        self.locations.update(zip(ids.tolist(), assignment.tolist()))
+        if self.keep_vectors:
+            rows = self.allocate_rows(len(ids))
+            self.vectors[rows] = vectors
+            self.rows.update(zip(ids.tolist(), rows.tolist()))
+
+    def allocate_rows(self, n):
+        '''
+        Rows of self.vectors for {n} new vectors: freed rows first, then new
+        ones at the end, growing the array geometrically so that adding in
+        small batches stays linear overall.
+        '''
+        reused = self.free_rows[len(self.free_rows) - min(n, len(self.free_rows)):]
+        del self.free_rows[len(self.free_rows) - len(reused):]
+        new = np.arange(self.n_rows, self.n_rows + n - len(reused))
+        self.n_rows += len(new)
+        if self.n_rows > len(self.vectors):
+            grown = np.zeros((max(self.n_rows, 2 * len(self.vectors)), self.dim), dtype=np.float32)
+            grown[:len(self.vectors)] = self.vectors
+            self.vectors = grown
+        return np.concatenate([np.array(reused, dtype=np.int64), new])
+
+    def remove(self, ids):
+        for i in ids:
+            if i in self.locations:
+                self.removed.add(i)
+
+    def compact(self):
+        '''
+        Drop removed ids from the lists and free their raw vectors' rows.
+        '''
+        if not self.removed:
+            return
+        removed = np.array(list(self.removed), dtype=np.int64)
+        for list_no in {self.locations[i] for i in self.removed}:
+            keep = ~np.isin(self.list_ids[list_no], removed)
+            self.list_ids[list_no] = self.list_ids[list_no][keep]
+            self.list_codes[list_no] = self.list_codes[list_no][keep]
+        for i in self.removed:
+            del self.locations[i]
+            row = self.rows.pop(i, None)
+            if row is not None:
+                self.free_rows.append(row)
+        self.removed = set()
+
+    def search(self, query, k, n_probe=None, rerank=None):
+        '''
+        The ids and (approximate, unless reranked) scores of the k vectors
+        with the highest inner product with {query}, best first.
+        '''
+        n_probe = n_probe or self.n_probe
+        rerank = self.rerank if rerank is None else rerank
+        if rerank and not self.keep_vectors:
+            raise ValueError("cannot rerank: the index was built with rerank=0, so it keeps no raw vectors")
+        query = np.asarray(query, dtype=np.float32)
+
+        coarse = self.centroids @ query
+        probes = top_k(coarse, n_probe)
+        # query . (centroid + residual) = query . centroid + sum of query . codeword over slices
+        tables = np.stack([np.pad(codebook @ query[dims], (0, self.n_codes - len(codebook))) for dims, codebook in zip(self.slices, self.codebooks)])
+        ids = np.concatenate([self.list_ids[p] for p in probes])
+        if not len(ids):
+            return ids, np.zeros(0, dtype=np.float32)
+        codes = np.vstack([self.list_codes[p] for p in probes]).astype(np.int64)
+        scores = np.repeat(coarse[probes], [len(self.list_ids[p]) for p in probes])
+        scores = scores + tables[np.arange(len(self.slices)), codes].sum(axis=1)
+
+        if self.removed:
+            live = ~np.isin(ids, np.array(list(self.removed), dtype=np.int64))
+            ids, scores = ids[live], scores[live]
+
+        if rerank:
+            candidates = top_k(scores, k * rerank)
+            ids = ids[candidates]
+            scores = self.vectors[[self.rows[i] for i in ids.tolist()]] @ query
+        best = top_k(scores, k)
+        return ids[best], scores[best]
+
+
+def benchmark_ann(n_vectors=1000000, dim=12, k=10, n_queries=200, n_lists=1024, probes=(1, 4, 8, 16, 32), rerank=16, seed=0):
+    '''
+    Build exact and IVF-PQ indexes over {n_vectors} random unit topic
+    vectors and report, for each n_probe, recall@k against exact search and
+    queries per second.
+    '''
+    rng = np.random.default_rng(seed)
+    vectors = rng.dirichlet(np.full(dim, 0.3), n_vectors).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = vectors[rng.choice(n_vectors, n_queries, replace=False)]
+    ids = np.arange(n_vectors)
+
+    exact = ExactIndex(dim)
+    exact.add(ids, vectors)
+    start = time.perf_counter()
+    truth = [set(exact.search(query, k)[0].tolist()) for query in queries]
+    exact_qps = n_queries / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    index = IVFPQIndex(dim, n_lists=n_lists, rerank=rerank, seed=seed)
+    index.add(ids, vectors)
+    build_time = time.perf_counter() - start
+
+    results = {"exact_qps": exact_qps, "build_time": build_time, "probes": []}
+    print(f"{n_vectors} vectors: exact search {exact_qps:.0f} queries/sec, IVF-PQ built in {build_time:.1f}s")
+    for n_probe in probes:
+        start = time.perf_counter()
+        found = [index.search(query, k, n_probe=n_probe)[0] for query in queries]
+        qps = n_queries / (time.perf_counter() - start)
+        recall = np.mean([len(truth_ids.intersection(f.tolist())) / k for truth_ids, f in zip(truth, found)])
+        results["probes"].append({"n_probe": n_probe, "recall": recall, "qps": qps})
+        print(f"n_probe {n_probe}: recall@{k} {recall:.3f}, {qps:.0f} queries/sec")
+    return results
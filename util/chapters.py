@@ -0,0 +1,123 @@
+'''
+# Streaming extraction of chapters from AO3 full-work pages.
+#
+# Andrew Zhou
+#
+# Feeds the page into an incremental HTML parser as it downloads and yields
+# each chapter as soon as its closing tag arrives, so only one chapter is in
+# memory at a time, however long the work is.
+'''
+
+import re
+from collections import deque
+from html.parser import HTMLParser
+import util.scrape as scrape
+
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"}
+CHAPTER_ID = re.compile(r"chapter-\d+$")
+
+
+class ChapterStreamParser(HTMLParser):
+    '''
+    Incremental parser for the #chapters block of a full-work page. Text is
+    taken from the paragraphs of .userstuff elements, as in chap_html_to_str,
+    and each finished chapter is queued in self.ready.
+    '''
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        # open elements, each with the set of roles it plays
+        self.stack = []
+        self.active = {"chapters": 0, "chapter": 0, "userstuff": 0, "p": 0, "title": 0}
+        self.ready = deque()
+        self.chapter = None
+        self.paragraph = []
+        self.count = 0
+
+    def start_chapter(self):
+        self.count += 1
+        self.chapter = {"index": self.count, "title": [], "paragraphs": []}
+
+    def end_chapter(self):
+        text = ' '.join(self.chapter["paragraphs"])
+        title = ''.join(self.chapter["title"]).strip()
+        self.ready.append({"index": self.chapter["index"], "title": title, "text": text, "paragraphs": len(self.chapter["paragraphs"]), "words": len(text.split())})
+        self.chapter = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            return
+        attrs = dict(attrs)
+        classes = (attrs.get("class") or "").split()
+        elem_id = attrs.get("id") or ""
+        roles = set()
+
+        if tag == "div" and elem_id == "chapters":
+            roles.add("chapters")
+        elif self.active["chapters"]:
+            if tag == "div" and "chapter" in classes and CHAPTER_ID.match(elem_id):
+                roles.add("chapter")
+                self.start_chapter()
+            elif self.active["chapter"] and tag == "h3" and "title" in classes:
+                roles.add("title")
+            if "userstuff" in classes:
+                roles.add("userstuff")
+                # single-chapter works have no chapter divs
+                if self.chapter is None:
+                    self.start_chapter()
+            elif tag == "p" and self.active["userstuff"]:
+                roles.add("p")
+
+        for role in roles:
+            self.active[role] += 1
+        self.stack.append((tag, roles))
+
+    def handle_endtag(self, tag):
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i][0] == tag:
+                break
+        else:
+            return
+
+        # close the element and anything left open inside it
+        while len(self.stack) > i:
+            _, roles = self.stack.pop()
+            for role in roles:
+                self.active[role] -= 1
+            if "p" in roles and not self.active["p"]:
+                text = ''.join(self.paragraph).replace("\xa0", " ")
+                if text:
+                    self.chapter["paragraphs"].append(text)
+                self.paragraph = []
+            if "chapter" in roles or ("chapters" in roles and self.chapter is not None):
+                self.end_chapter()
+
+    def handle_data(self, data):
+        if self.active["p"]:
+            self.paragraph.append(data)
+        if self.active["title"] and self.chapter is not None:
+            self.chapter["title"].append(data)
+
+
+def iter_chapters(work_id, fetcher=None, chunk_size=65536):
+    '''
+    Stream a work's full-text page and yield its chapters one at a time, as
+    dicts with the work_id, chapter index and title, text, and paragraph and
+    word counts. Joining the texts with spaces gives scrape_fic's "text".
+
+    Consumers that iterate over documents, such as process_texts or
+    chunk_docs, can take the chapter texts directly:
+    process_texts(ch["text"] for ch in iter_chapters(work_id)).
+    '''
+    if fetcher is None:
+        fetcher = scrape.get_fetcher()
+
+    url = scrape.base_url + '/works/' + str(work_id) + "?view_full_work=true?view_adult=true"
+
+    parser = ChapterStreamParser()
+    for chunk in fetcher.iter_text(url, chunk_size):
+        parser.feed(chunk)
+        while parser.ready:
+            yield {"work_id": work_id, **parser.ready.popleft()}
+    parser.close()
+    while parser.ready:
+        yield {"work_id": work_id, **parser.ready.popleft()}
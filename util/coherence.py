@@ -0,0 +1,233 @@
+'''
+# Fast c_v topic coherence with reusable co-occurrence counts.
+#
+# Andrew Zhou
+#
+# gensim's CoherenceModel rescans the corpus with sliding windows for every
+# model. Here the window counts for the top words of a whole batch of models
+# are gathered in one scan and kept, so scoring further models whose top
+# words were already seen needs no scan at all.
+#
+# Sources of code and information:
+# http://svn.aksw.org/papers/2015/WSDM_Topic_Evaluation/public.pdf
+# https://radimrehurek.com/gensim/models/coherencemodel.html
+'''
+
+import multiprocessing
+import os
+import numpy as np
+from scipy import sparse
+from util.corpus import TokenCorpus
+
+# same smoothing constant as gensim's direct confirmation measures
+EPSILON = 1e-12
+
+# Per-worker state for the counting pool, sent once per worker process
+worker_state = {}
+
+
+def count_windows(ids, window_size=110, sample=None, rng=None):
+    '''
+    Count the sliding windows of one document that contain each relevant
+    word, and each pair of them, given {ids}, the document's tokens as
+    relevant-word indices (-1 for any other token). Returns
+    (present, occurrences, co-occurrences, windows), where present are the
+    relevant indices in the document and the counts are over those only.
+
+    The windows are gensim's (WordOccurrenceAccumulator), not exact boolean
+    windows: a document shorter than the window is a single window, and as
+    the window slides, a word drops out of view whenever one of its tokens
+    leaves it, even if another of its tokens is still inside, until its
+    next token comes into view. Consecutive windows that contain the same relevant words are counted
+    together, so the cost follows the number of relevant tokens rather than
+    the number of windows. With {sample}, only that fraction of windows is
+    drawn at random and counted.
+    '''
+    positions = np.flatnonzero(ids >= 0)
+    if not len(positions):
+        return None
+    present, local = np.unique(ids[positions], return_inverse=True)
+
+    n_windows = max(1, len(ids) - window_size + 1)
+    # the window starts that see each relevant token, inclusive, except that
+    # a word is in view only until the next of its tokens leaves the window
+    first = np.maximum(positions - window_size + 1, 0)
+    key = local * (len(ids) + 1)
+    order = np.argsort(key + positions, kind="stable")
+    leaving = np.searchsorted((key + positions)[order], key + first, "left")
+    last = np.minimum(positions[order][leaving], n_windows - 1)
+
+    if sample is not None and n_windows > 1:
+        n_sampled = max(1, int(round(n_windows * sample)))
+        starts = np.sort(rng.choice(n_windows, n_sampled, replace=False))
+        weights = np.ones(n_sampled)
+        n_windows = n_sampled
+    else:
+        # window starts where the set of relevant words in view can change
+        starts = np.unique(np.concatenate(([0], first, last + 1)))
+        starts = starts[starts < n_windows]
+        weights = np.diff(np.append(starts, n_windows)).astype(np.float64)
+
+    lo = np.searchsorted(starts, first, "left")
+    hi = np.searchsorted(starts, last, "right")
+    # number of each word's tokens in view, as a running sum of +1/-1 at
+    # the columns where each token comes into and goes out of view
+    in_view = np.zeros((len(present), len(starts) + 1), dtype=np.int16)
+    np.add.at(in_view, (local, lo), 1)
+    np.add.at(in_view, (local, hi), -1)
+    np.cumsum(in_view, axis=1, out=in_view)
+    in_view = in_view[:, :-1]
+
+    occurrences = np.zeros(len(present))
+    co_occurrences = np.zeros((len(present), len(present)))
+    for start in range(0, len(starts), 4096):
+        block = (in_view[:, start:start+4096] > 0).astype(np.float64)
+        block_weights = weights[start:start+4096]
+        occurrences += block @ block_weights
+        co_occurrences += (block * block_weights) @ block.T
+    return present, occurrences, co_occurrences, n_windows
+
+
+class CoherenceEvaluator():
+    '''
+    c_v coherence (boolean sliding windows, one-set segmentation, indirect
+    cosine confirmation over NPMI, as CoherenceModel(coherence='c_v')) for
+    many models over the same documents.
+
+    The counts gathered for one batch of models are kept and reused for any
+    later model whose top words they cover, regardless of the Dictionary
+    the model was trained with. With n_jobs > 1 (or -1 for every core)
+    documents are counted in a process pool; with {sample}, a random
+    fraction of each document's windows is counted, which approximates the
+    score in proportionally less time.
+    '''
+    def __init__(self, docs, window_size=110, topn=20, sample=None, n_jobs=1, seed=0):
+        self.docs = docs
+        self.window_size = window_size
+        self.topn = topn
+        self.sample = sample
+        self.n_jobs = n_jobs if n_jobs > 0 else os.cpu_count()
+        self.seed = seed
+
+        # relevant word -> index, and the counts over them
+        self.vocab = {}
+        self.occurrences = None
+        self.co_occurrences = None
+        # windows per document, and which relevant words each one contains
+        self.windows = None
+        self.presence = None
+        self.scans = 0
+
+    def get_topics(self, model):
+        '''
+        The top words of each of the model's topics.
+        '''
+        topics = model.get_topics()
+        top = np.argsort(-topics, axis=1, kind="stable")[:, :self.topn]
+        return [[model.id2word[word_id] for word_id in row] for row in top]
+
+    def iter_ids(self):
+        '''
+        Each document as an array of relevant-word indices.
+        '''
+        if isinstance(self.docs, TokenCorpus):
+            lookup = np.array([self.vocab.get(token, -1) for token in self.docs.id2token], dtype=np.int64)
+            for doc_ids in self.docs.iter_ids():
+                yield lookup[doc_ids]
+        else:
+            vocab = self.vocab
+            for doc in self.docs:
+                yield np.fromiter((vocab.get(token, -1) for token in doc), dtype=np.int64, count=len(doc))
+
+    def accumulate(self, words):
+        '''
+        Make sure the counts cover {words}, rescanning the documents once (for
+        these and all previously counted words) if they do not yet.
+        '''
+        if all(word in self.vocab for word in words):
+            return
+        for word in sorted(set(words) - self.vocab.keys()):
+            self.vocab[word] = len(self.vocab)
+        n_relevant = len(self.vocab)
+
+        occurrences = np.zeros(n_relevant)
+        co_occurrences = np.zeros((n_relevant, n_relevant))
+        windows = []
+        rows, cols = [], []
+
+        def add(doc_index, counts):
+            windows.append(0)
+            if counts is None:
+                return
+            present, doc_occurrences, doc_co_occurrences, n_windows = counts
+            occurrences[present] += doc_occurrences
+            co_occurrences[np.ix_(present, present)] += doc_co_occurrences
+            windows[-1] = n_windows
+            rows.append(np.full(len(present), doc_index))
+            cols.append(present)
+
+        items = enumerate(self.iter_ids())
+        if self.n_jobs == 1:
+            for i, ids in items:
+                add(i, count_windows(ids, self.window_size, self.sample, np.random.default_rng((self.seed, i))))
+        else:
+            with multiprocessing.Pool(self.n_jobs, initializer=init_count_worker, initargs=(self.window_size, self.sample, self.seed)) as pool:
+                # imap keeps document order, so results line up with indices
+                for i, counts in enumerate(pool.imap(count_worker, items, chunksize=16)):
+                    add(i, counts)
+
+        self.occurrences = occurrences
+        self.co_occurrences = co_occurrences
+        self.windows = np.array(windows, dtype=np.int64)
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+        self.presence = sparse.csc_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(len(windows), n_relevant))
+        self.scans += 1
+
+    def score_topics(self, topics, per_topic=False):
+        '''
+        c_v coherence of a model given its topics' top words, averaged over
+        topics (or one score per topic if {per_topic}).
+        '''
+        self.accumulate([word for topic in topics for word in topic])
+        relevant = np.unique([self.vocab[word] for topic in topics for word in topic])
+        # as in gensim, only windows of documents that contain one of the
+        # model's top words count towards the total
+        relevant_docs = self.presence[:, relevant].getnnz(axis=1) > 0
+        num_windows = self.windows[relevant_docs].sum()
+
+        scores = []
+        for topic in topics:
+            index = np.array([self.vocab[word] for word in topic])
+            prob = self.occurrences[index] / num_windows
+            co_prob = self.co_occurrences[np.ix_(index, index)] / num_windows
+            with np.errstate(divide="ignore", invalid="ignore"):
+                npmi = np.log((co_prob + EPSILON) / np.outer(prob, prob)) / -np.log(co_prob + EPSILON)
+            npmi = np.nan_to_num(npmi, nan=0.0, posinf=0.0, neginf=0.0)
+
+            # each word's context vector against that of the whole topic
+            topic_vector = npmi.sum(axis=0)
+            norms = np.linalg.norm(npmi, axis=1) * np.linalg.norm(topic_vector)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                sims = np.where(norms > 0, npmi @ topic_vector / norms, 0.0)
+            scores.append(float(sims.mean()))
+        return scores if per_topic else float(np.mean(scores))
+
+    def score_many(self, models_topics):
+        '''
+        Score several models, given their topics as from get_topics, counting
+        windows for all of them in a single scan.
+        '''
+        self.accumulate([word for topics in models_topics for topic in topics for word in topic])
+        return [self.score_topics(topics) for topics in models_topics]
+
+    def score(self, model):
+        return self.score_topics(self.get_topics(model))
+
+
+def init_count_worker(window_size, sample, seed):
+    worker_state.update(window_size=window_size, sample=sample, seed=seed)
+
+def count_worker(item):
+    i, ids = item
+    return count_windows(ids, worker_state["window_size"], worker_state["sample"], np.random.default_rng((worker_state["seed"], i)))
@@ -0,0 +1,132 @@
+'''
+# Compact, memory-mapped storage for processed documents.
+#
+# Andrew Zhou
+#
+# A corpus directory holds the vocabulary (vocab.json), every document's
+# token ids back to back in one flat int32 file (tokens.int32), and where
+# each document starts in an int64 offsets file (offsets.int64).
+'''
+
+import json
+import os
+import numpy as np
+from gensim.corpora import Dictionary
+
+
+class TokenCorpus():
+    '''
+    Memory-mapped corpus of processed documents. Iterating over it yields
+    each document as a list of tokens, so it can stand in for a list of
+    processed documents (e.g. in LDATuner), but only one document is
+    materialized at a time.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "vocab.json"), "r", encoding="utf-8") as f:
+            self.id2token = json.load(f)
+        tokens_path = os.path.join(directory, "tokens.int32")
+        if os.path.getsize(tokens_path):
+            self.tokens = np.memmap(tokens_path, dtype=np.int32, mode="r")
+        else:
+            # numpy cannot memory-map an empty file
+            self.tokens = np.zeros(0, dtype=np.int32)
+        self.offsets = np.memmap(os.path.join(directory, "offsets.int64"), dtype=np.int64, mode="r")
+
+    @classmethod
+    def build(cls, docs, directory):
+        '''
+        Write {docs}, an iterable of token lists such as fic_df["processed"],
+        to {directory} and open it. Token ids are assigned in the same order
+        as gensim's Dictionary, so the two agree.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        token2id = {}
+        offsets = [0]
+        with open(os.path.join(directory, "tokens.int32"), "wb") as f:
+            for doc in docs:
+                for token in sorted(set(doc) - token2id.keys()):
+                    token2id[token] = len(token2id)
+                np.array([token2id[token] for token in doc], dtype=np.int32).tofile(f)
+                offsets.append(offsets[-1] + len(doc))
+
+        np.array(offsets, dtype=np.int64).tofile(os.path.join(directory, "offsets.int64"))
+        id2token = sorted(token2id, key=token2id.get)
+        with open(os.path.join(directory, "vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(id2token, f)
+        return cls(directory)
+
+    def __reduce__(self):
+        # reopen the memory maps rather than copying them, e.g. into workers
+        return (TokenCorpus, (self.directory,))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def doc_ids(self, i):
+        '''
+        The token ids of document {i}, as a view into the memory map.
+        '''
+        return self.tokens[self.offsets[i]:self.offsets[i+1]]
+
+    def __getitem__(self, i):
+        id2token = self.id2token
+        return [id2token[token_id] for token_id in self.doc_ids(i)]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def iter_ids(self):
+        for i in range(len(self)):
+            yield self.doc_ids(i)
+
+    def to_dictionary(self, block_size=1000):
+        '''
+        Build the gensim Dictionary that Dictionary(corpus) would, from the
+        token ids, without turning any document back into strings.
+        '''
+        num_terms = len(self.id2token)
+        cfs = np.bincount(self.tokens, minlength=num_terms)
+        dfs = np.zeros(num_terms, dtype=np.int64)
+        num_nnz = 0
+
+        for start in range(0, len(self), block_size):
+            end = min(start + block_size, len(self))
+            ids = np.asarray(self.tokens[self.offsets[start]:self.offsets[end]], dtype=np.int64)
+            doc_index = np.repeat(np.arange(end - start), np.diff(self.offsets[start:end+1]))
+            # each (document, token) pair once
+            pairs = np.unique(doc_index * num_terms + ids)
+            dfs += np.bincount(pairs % num_terms, minlength=num_terms)
+            num_nnz += len(pairs)
+
+        dictionary = Dictionary()
+        dictionary.token2id = {token: i for i, token in enumerate(self.id2token)}
+        dictionary.cfs = dict(enumerate(cfs.tolist()))
+        dictionary.dfs = dict(enumerate(dfs.tolist()))
+        dictionary.num_docs = len(self)
+        dictionary.num_pos = len(self.tokens)
+        dictionary.num_nnz = num_nnz
+        return dictionary
+
+    def bow_corpus(self, dictionary):
+        return BowCorpus(self, dictionary)
+
+
+class BowCorpus():
+    '''
+    Re-iterable bag-of-words view of a TokenCorpus for a (possibly filtered)
+    Dictionary, yielding the same lists as dictionary.doc2bow.
+    '''
+    def __init__(self, corpus, dictionary):
+        self.corpus = corpus
+        self.lookup = np.array([dictionary.token2id.get(token, -1) for token in corpus.id2token], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def __iter__(self):
+        for ids in self.corpus.iter_ids():
+            ids = self.lookup[ids]
+            ids, counts = np.unique(ids[ids >= 0], return_counts=True)
+            yield list(zip(ids.tolist(), counts.tolist()))
@@ -0,0 +1,125 @@
+'''
+# Persistent cache of preprocessed documents.
+#
+# Andrew Zhou
+#
+# Each processed document is stored gzipped under a hash of its text and a
+# hash of the preprocessing config, so re-running process_texts after a
+# re-scrape only processes the documents that actually changed.
+'''
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class ProcessedCache():
+    '''
+    Cache of processed documents (token lists) keyed by (config, text).
+
+    When the entries exceed {max_bytes}, the least recently used are evicted.
+    Access times are kept as file modification times, so recency survives
+    between runs.
+    '''
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+        # key -> (size on disk, last access time), used for eviction
+        self.index = {}
+        for name in os.listdir(directory):
+            if name.endswith(".json.gz"):
+                stat = os.stat(os.path.join(directory, name))
+                self.index[name[:-len(".json.gz")]] = (stat.st_size, stat.st_mtime)
+
+    @staticmethod
+    def get_config_key(stopwords, ngrams, stop_after, backend):
+        '''
+        Hash of everything besides the text that determines the output.
+        '''
+        config = {
+            "stopwords": sorted(stopwords),
+            "bigrams": sorted(ngrams.get("bigrams", [])),
+            "trigrams": sorted(ngrams.get("trigrams", [])),
+            "exceptions": sorted(ngrams.get("exceptions", {}).items()),
+            "stop_after": sorted(stop_after),
+            "backend": backend,
+        }
+        return hashlib.sha256(json.dumps(config).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def get_key(config_key, text):
+        text_key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return hashlib.sha256((config_key + text_key).encode("utf-8")).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + ".json.gz")
+
+    def get(self, key):
+        '''
+        Return the cached document, or None.
+        '''
+        try:
+            with open(self.get_path(key), "rb") as f:
+                doc = json.loads(gzip.decompress(f.read()).decode("utf-8"))
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        now = time.time()
+        try:
+            os.utime(self.get_path(key), (now, now))
+        except OSError:
+            pass
+        with self.lock:
+            self.hits += 1
+            if key in self.index:
+                self.index[key] = (self.index[key][0], now)
+        return doc
+
+    def store(self, key, doc):
+        path = self.get_path(key)
+        data = gzip.compress(json.dumps(doc).encode("utf-8"))
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self.lock:
+            self.index[key] = (len(data), time.time())
+
+    def remove(self, key):
+        try:
+            os.remove(self.get_path(key))
+        except FileNotFoundError:
+            pass
+        self.index.pop(key, None)
+
+    def evict(self):
+        '''
+        Remove least recently used entries until the cache fits in max_bytes.
+        '''
+        if self.max_bytes is None:
+            return
+        with self.lock:
+            total = sum(size for size, _ in self.index.values())
+            if total <= self.max_bytes:
+                return
+            for key, (size, _) in sorted(self.index.items(), key=lambda x: x[1][1]):
+                self.remove(key)
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.index), "bytes": sum(size for size, _ in self.index.values()), "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
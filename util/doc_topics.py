@@ -0,0 +1,93 @@
+'''
+# Dense document-topic matrices for trained LDA models.
+#
+# Andrew Zhou
+#
+# The matrix is saved as a float32 .npy file, so clustering, the recommender
+# and the notebooks can memory-map it instead of running gensim inference
+# over the whole corpus, one document at a time, every time.
+#
+# Sources of code and information:
+# https://radimrehurek.com/gensim/models/ldamodel.html
+'''
+
+import numpy as np
+from scipy import sparse
+from scipy.special import psi
+
+# same as gensim's LdaModel.inference
+GAMMA_THRESHOLD = 0.001
+
+
+def bow_to_sparse(corpus, num_terms):
+    '''
+    Turn a bag-of-words corpus into a (n_docs, num_terms) CSR count matrix.
+    '''
+    indptr = [0]
+    indices = []
+    data = []
+    for bow in corpus:
+        for term_id, count in bow:
+            indices.append(term_id)
+            data.append(count)
+        indptr.append(len(indices))
+    return sparse.csr_matrix((np.array(data, dtype=np.float64), np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64)), shape=(len(indptr) - 1, num_terms))
+
+def dirichlet_expectation(alpha):
+    return psi(alpha) - psi(alpha.sum(axis=1, keepdims=True))
+
+def infer_topics(model, corpus, batch_size=2000, iterations=None, minimum_probability=None, seed=0):
+    '''
+    The topic distribution of every document in {corpus}, as a float32
+    (n_docs, num_topics) matrix with the same values as model[bow].
+
+    This is gensim's variational inference, run on a batch of documents at
+    a time as sparse matrix products instead of a Python loop per document.
+    Documents stop updating once converged. As with model[bow], topics
+    below minimum_probability (the model's own by default) are zeroed.
+    '''
+    if not sparse.issparse(corpus):
+        corpus = bow_to_sparse(corpus, model.num_terms)
+    corpus = sparse.csr_matrix(corpus)
+    iterations = iterations or model.iterations
+    if minimum_probability is None:
+        minimum_probability = model.minimum_probability
+
+    exp_elog_beta = model.expElogbeta
+    alpha = np.asarray(model.alpha, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    doc_topics = np.zeros((corpus.shape[0], model.num_topics), dtype=np.float32)
+
+    for start in range(0, corpus.shape[0], batch_size):
+        counts = corpus[start:start+batch_size]
+        rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+        cols = counts.indices
+        gamma = rng.gamma(100., 1. / 100., (counts.shape[0], model.num_topics))
+        active = np.ones(counts.shape[0], dtype=bool)
+
+        for _ in range(iterations):
+            exp_elog_theta = np.exp(dirichlet_expectation(gamma))
+            # only the words each document contains matter
+            phinorm = np.einsum("ij,ji->i", exp_elog_theta[rows], exp_elog_beta[:, cols]) + 1e-100
+            weighted = sparse.csr_matrix((counts.data / phinorm, cols, counts.indptr), shape=counts.shape)
+            new_gamma = alpha + exp_elog_theta * (weighted @ exp_elog_beta.T)
+
+            change = np.abs(new_gamma - gamma).mean(axis=1)
+            gamma[active] = new_gamma[active]
+            active &= change >= GAMMA_THRESHOLD
+            if not active.any():
+                break
+
+        theta = gamma / gamma.sum(axis=1, keepdims=True)
+        theta[theta < minimum_probability] = 0.0
+        doc_topics[start:start+counts.shape[0]] = theta
+    return doc_topics
+
+def save_doc_topics(path, doc_topics):
+    np.save(path, np.asarray(doc_topics, dtype=np.float32))
+
+def load_doc_topics(path):
+    '''
+    Memory-map a saved document-topic matrix.
+    '''
+    return np.load(path, mmap_mode="r")
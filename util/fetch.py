@@ -0,0 +1,262 @@
+'''
+# HTTP helpers for the AO3 scraper: a pooled session and a per-host rate
+# limiter shared by every worker thread.
+#
+# Andrew Zhou
+'''
+
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from util.http_cache import CacheMissError
+
+# Status codes that mean "slow down" rather than "this page is broken".
+THROTTLE_STATUS = (429, 503)
+RETRY_STATUS = (500, 502, 504)
+
+
+class TokenBucket():
+    '''
+    Thread-safe token bucket. Allows bursts of up to {capacity} requests and
+    refills at {rate} requests per second.
+    '''
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait_time(self):
+        '''
+        Seconds until a token is available; takes it if there is one already.
+        Must be called with the lock held.
+        '''
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        '''
+        Block until a token is available, then take it.
+        '''
+        while True:
+            with self.lock:
+                wait = self.wait_time()
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class AdaptiveThrottle(TokenBucket):
+    '''
+    Token bucket whose rate follows AIMD: each success adds {increase}
+    requests/sec up to {max_rate}, and each 429/503 multiplies the rate by
+    {decrease} down to {min_rate}. A Retry-After header pauses the host
+    entirely until it has passed.
+
+    By default the rate never goes above its starting value, only backing
+    off (to as little as a sixteenth of it) and recovering; pass a higher
+    max_rate to let it ramp up past that.
+    '''
+    def __init__(self, rate, capacity=1, min_rate=None, max_rate=None, increase=None, decrease=0.5):
+        super().__init__(rate, capacity)
+        self.min_rate = min_rate if min_rate else rate / 16
+        self.max_rate = max_rate if max_rate else rate
+        self.increase = increase if increase else rate / 10
+        self.decrease = decrease
+        self.paused_until = 0
+
+    def wait_time(self):
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            return pause
+        return super().wait_time()
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self, retry_after=None):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+
+def parse_retry_after(value):
+    '''
+    Parse a Retry-After header, given either in seconds or as an HTTP date.
+    '''
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class Fetcher():
+    '''
+    Fetches pages over a keep-alive connection pool, with one adaptive token
+    bucket per host so that all threads together respect the rate limit.
+    Throttled and transient failures are retried up to {max_retries} times
+    with jittered exponential backoff. Requests never go faster than {rate}
+    per host unless a higher {max_rate} is given. Given a ResponseCache,
+    pages are served from disk and revalidated when stale.
+    '''
+    def __init__(self, rate=0.2, burst=1, pool_size=4, timeout=60, headers=None, cache=None, max_rate=None, min_rate=None, max_retries=4, backoff=2.0):
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        self.cache = cache
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if headers:
+            self.session.headers.update(headers)
+
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+        # (time, succeeded) for each request in the last metrics_window seconds
+        self.metrics_window = 60
+        self.history = deque()
+
+    def get_limiter(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.limiters:
+                self.limiters[host] = AdaptiveThrottle(self.rate, self.burst, min_rate=self.min_rate, max_rate=self.max_rate)
+            return self.limiters[host]
+
+    def record(self, succeeded):
+        now = time.monotonic()
+        with self.lock:
+            self.history.append((now, succeeded))
+            while self.history and self.history[0][0] < now - self.metrics_window:
+                self.history.popleft()
+
+    def metrics(self):
+        '''
+        Requests/sec and error rate over the last minute, and the current delay
+        between requests for each host.
+        '''
+        now = time.monotonic()
+        with self.lock:
+            recent = [ok for t, ok in self.history if t >= now - self.metrics_window]
+            delays = {host: 1 / limiter.rate for host, limiter in self.limiters.items()}
+        return {"requests_per_sec": len(recent) / self.metrics_window, "error_rate": recent.count(False) / len(recent) if recent else 0.0, "delay": delays}
+
+    def get(self, url):
+        '''
+        Wait for the host's rate limiter, then fetch the page and return its text.
+        '''
+        meta = None
+        headers = {}
+        if self.cache is not None:
+            meta = self.cache.lookup(url)
+            if meta and (self.cache.offline or self.cache.is_fresh(meta)):
+                return self.cache.read_body(meta)
+            if self.cache.offline:
+                raise CacheMissError(url)
+            if meta:
+                headers = self.cache.conditional_headers(meta)
+
+        r = self.request(url, headers)
+
+        if r.status_code == 304 and meta:
+            return self.cache.read_body(meta, revalidated=True)
+        r.raise_for_status()
+
+        if self.cache is not None:
+            self.cache.store(url, r.text, r.headers.get("ETag"), r.headers.get("Last-Modified"))
+        return r.text
+
+    def iter_text(self, url, chunk_size=65536):
+        '''
+        Like get, but yield the page's text in chunks as it is downloaded.
+        Streamed pages are read from the cache but not written to it.
+        '''
+        meta = self.cache.lookup(url) if self.cache is not None else None
+        if self.cache is not None and (meta or self.cache.offline):
+            if self.cache.offline or self.cache.is_fresh(meta):
+                body = self.get(url)
+                for i in range(0, len(body), chunk_size):
+                    yield body[i:i+chunk_size]
+                return
+
+        r = self.request(url, self.cache.conditional_headers(meta) if meta else {}, stream=True)
+        if r.status_code == 304 and meta:
+            body = self.cache.read_body(meta, revalidated=True)
+            for i in range(0, len(body), chunk_size):
+                yield body[i:i+chunk_size]
+            return
+        r.raise_for_status()
+
+        if r.encoding is None:
+            r.encoding = "utf-8"
+        try:
+            for chunk in r.iter_content(chunk_size, decode_unicode=True):
+                yield chunk
+        finally:
+            r.close()
+
+    def request(self, url, headers, stream=False):
+        '''
+        Send a GET through the host's limiter, retrying throttled and transient
+        failures, and return the final response.
+        '''
+        limiter = self.get_limiter(url)
+        attempt = 0
+        while True:
+            limiter.acquire()
+            try:
+                r = self.session.get(url, headers=headers, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout):
+                self.record(False)
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                if r.status_code in THROTTLE_STATUS:
+                    self.record(False)
+                    limiter.on_throttle(parse_retry_after(r.headers.get("Retry-After")))
+                elif r.status_code in RETRY_STATUS:
+                    self.record(False)
+                else:
+                    break
+                if attempt >= self.max_retries:
+                    r.raise_for_status()
+                r.close()
+
+            # full jitter, so that threads that failed together retry apart
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            attempt += 1
+
+        self.record(r.ok)
+        if r.ok:
+            limiter.on_success()
+        return r
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,165 @@
+'''
+# On-disk cache of HTTP responses for the AO3 scraper.
+#
+# Andrew Zhou
+#
+# Bodies are stored gzipped under a hash of their URL, next to a small JSON
+# file with the ETag/Last-Modified validators used for conditional GETs.
+'''
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class CacheMissError(KeyError):
+    '''
+    Raised in offline mode when a URL has never been cached.
+    '''
+
+
+class ResponseCache():
+    '''
+    Cache of response bodies keyed by URL.
+
+    Entries younger than {ttl} seconds are served as is (ttl=None never
+    expires them); older ones are revalidated with a conditional GET. When
+    the bodies exceed {max_bytes}, the least recently used are evicted. In
+    {offline} mode the network is never touched.
+    '''
+    def __init__(self, directory, ttl=None, max_bytes=None, offline=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+        # key -> (size on disk, last access time), used for eviction
+        self.index = {}
+        for name in os.listdir(directory):
+            if name.endswith(".json"):
+                meta = self.read_meta(name[:-len(".json")])
+                if meta:
+                    self.index[meta["key"]] = (meta["size"], meta["accessed"])
+
+    @staticmethod
+    def get_key(url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def get_path(self, key, ext):
+        return os.path.join(self.directory, key + ext)
+
+    def read_meta(self, key):
+        try:
+            with open(self.get_path(key, ".json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_atomic(self, path, data):
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def write_meta(self, meta):
+        self.write_atomic(self.get_path(meta["key"], ".json"), json.dumps(meta).encode("utf-8"))
+
+    def lookup(self, url):
+        '''
+        Return the metadata for a cached URL, or None.
+        '''
+        meta = self.read_meta(self.get_key(url))
+        if meta is None or not os.path.exists(self.get_path(meta["key"], ".gz")):
+            return None
+        return meta
+
+    def is_fresh(self, meta):
+        return self.ttl is None or time.time() - meta["fetched"] < self.ttl
+
+    def conditional_headers(self, meta):
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def read_body(self, meta, revalidated=False):
+        '''
+        Read a cached body, refreshing its access (and fetch, if it was just
+        revalidated) time.
+        '''
+        with open(self.get_path(meta["key"], ".gz"), "rb") as f:
+            body = gzip.decompress(f.read()).decode("utf-8")
+
+        now = time.time()
+        meta["accessed"] = now
+        if revalidated:
+            meta["fetched"] = now
+        with self.lock:
+            self.hits += 1
+            self.revalidated += revalidated
+            self.index[meta["key"]] = (meta["size"], now)
+        self.write_meta(meta)
+        return body
+
+    def store(self, url, body, etag=None, last_modified=None):
+        key = self.get_key(url)
+        data = gzip.compress(body.encode("utf-8"))
+        now = time.time()
+        meta = {"key": key, "url": url, "etag": etag, "last_modified": last_modified, "fetched": now, "accessed": now, "size": len(data)}
+
+        self.write_atomic(self.get_path(key, ".gz"), data)
+        self.write_meta(meta)
+        with self.lock:
+            self.misses += 1
+            self.index[key] = (len(data), now)
+        self.evict()
+
+    def remove(self, key):
+        for ext in (".gz", ".json"):
+            try:
+                os.remove(self.get_path(key, ext))
+            except FileNotFoundError:
+                pass
+        self.index.pop(key, None)
+
+    def evict(self):
+        '''
+        Remove least recently used entries until the cache fits in max_bytes.
+        '''
+        if self.max_bytes is None:
+            return
+        with self.lock:
+            total = sum(size for size, _ in self.index.values())
+            if total <= self.max_bytes:
+                return
+            for key, (size, _) in sorted(self.index.items(), key=lambda x: x[1][1]):
+                self.remove(key)
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+    def iter_pages(self, match=""):
+        '''
+        Yield (url, body) for every cached URL containing {match}, e.g. to
+        benchmark parsers on recorded pages.
+        '''
+        for key in list(self.index):
+            meta = self.read_meta(key)
+            if meta and match in meta["url"]:
+                with open(self.get_path(key, ".gz"), "rb") as f:
+                    yield meta["url"], gzip.decompress(f.read()).decode("utf-8")
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.index), "bytes": sum(size for size, _ in self.index.values()), "hits": self.hits, "misses": self.misses, "revalidated": self.revalidated}
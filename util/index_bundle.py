@@ -0,0 +1,124 @@
+'''
+# Prebuilt index bundle for the recommender app.
+#
+# Andrew Zhou
+#
+# Everything the app needs to recommend fics, built once offline: the
+# document-topic matrix, its rows normalized to unit length for cosine
+# similarity, the fic metadata, and the model and Dictionary used to place
+# new favorites in topic space. The arrays are memory-mapped at startup, so
+# a cold start does no inference and builds no index.
+'''
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import pickle
+import numpy as np
+from gensim.corpora import Dictionary
+from gensim.models import LdaModel
+from util.doc_topics import infer_topics, load_doc_topics
+
+# bumped whenever the files in a bundle change
+BUNDLE_FORMAT = 1
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32)
+
+def build_index_bundle(directory, model, dictionary, fic_info, corpus=None, doc_topics=None, model_version=None):
+    '''
+    Write the bundle for {model} to {directory}, replacing any previous one.
+    The document-topic matrix is inferred from {corpus} unless it is passed
+    in as {doc_topics}; its rows must line up with {fic_info}.
+    '''
+    if doc_topics is None:
+        doc_topics = infer_topics(model, corpus)
+    doc_topics = np.asarray(doc_topics, dtype=np.float32)
+    if len(doc_topics) != len(fic_info):
+        raise ValueError(f"{len(doc_topics)} topic rows for {len(fic_info)} fics")
+
+    tmp = directory.rstrip(os.sep) + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    np.save(os.path.join(tmp, "doc_topics.npy"), doc_topics)
+    np.save(os.path.join(tmp, "vectors.npy"), normalize_rows(doc_topics))
+    with open(os.path.join(tmp, "fic_info.json"), "w", encoding="utf-8") as f:
+        json.dump(list(fic_info), f, default=lambda x: x.item() if isinstance(x, np.generic) else str(x))
+    dictionary.save(os.path.join(tmp, "dictionary.dict"))
+    model.save(os.path.join(tmp, "lda.model"))
+
+    manifest = {"format": BUNDLE_FORMAT, "built": time.time(), "model_version": model_version, "num_docs": len(doc_topics), "num_topics": model.num_topics, "num_terms": len(dictionary)}
+    with open(os.path.join(tmp, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+
+    # swap the finished bundle in for the old one
+    old = directory.rstrip(os.sep) + ".old"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(directory):
+        os.rename(directory, old)
+    os.rename(tmp, directory)
+    shutil.rmtree(old, ignore_errors=True)
+    return manifest
+
+def load_index_bundle(directory):
+    '''
+    Load a bundle built by build_index_bundle, memory-mapping its arrays
+    (including the model's).
+    '''
+    with open(os.path.join(directory, "manifest.json"), "r") as f:
+        manifest = json.load(f)
+    if manifest["format"] != BUNDLE_FORMAT:
+        raise ValueError(f"index bundle format {manifest['format']} is not {BUNDLE_FORMAT}; rebuild it with build_index_bundle")
+
+    with open(os.path.join(directory, "fic_info.json"), "r", encoding="utf-8") as f:
+        fic_info = json.load(f)
+    return {
+        "manifest": manifest,
+        "doc_topics": load_doc_topics(os.path.join(directory, "doc_topics.npy")),
+        "vectors": load_doc_topics(os.path.join(directory, "vectors.npy")),
+        "fic_info": fic_info,
+        "dictionary": Dictionary.load(os.path.join(directory, "dictionary.dict")),
+        "model": LdaModel.load(os.path.join(directory, "lda.model"), mmap="r"),
+    }
+
+def benchmark_startup(directory, model_path="../models/avatar_model.pickle", fic_info_path="../data/fic_info.pickle", repeat=3):
+    '''
+    Compare the app's cold start from the pickled model (inferring topics
+    for the whole corpus and building a gensim Similarity index, as the app
+    used to) with loading the bundle in {directory}. Reports the best of
+    {repeat} runs, in seconds.
+    '''
+    from gensim.similarities import Similarity
+
+    def from_pickles():
+        with open(fic_info_path, "rb") as f:
+            pickle.load(f)
+        with open(model_path, "rb") as f:
+            model_info = pickle.load(f)
+        model = model_info["model"]
+        with tempfile.TemporaryDirectory() as tmp:
+            Similarity(os.path.join(tmp, "index"), model[model_info["corpus"]], num_features=model.num_topics)
+
+    def from_bundle():
+        bundle = load_index_bundle(directory)
+        # touch the vectors, as the first recommendation would
+        float(bundle["vectors"].sum())
+
+    times = {}
+    for name, start_up in (("pickles", from_pickles), ("bundle", from_bundle)):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            start_up()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        times[name] = best
+
+    print(f"cold start from pickles: {times['pickles']:.2f}s, from bundle: {times['bundle']:.2f}s ({times['pickles'] / times['bundle']:.0f}x faster)")
+    return times
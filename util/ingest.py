@@ -0,0 +1,111 @@
+'''
+# Incremental ingestion of new and updated AO3 works.
+#
+# Andrew Zhou
+#
+# Search results are sorted by when each work last changed, newest first, so
+# a work that gains a chapter moves to the top, and a refresh only needs to
+# page until it reaches a run of works we already have with unchanged
+# metadata.
+'''
+
+import json
+import re
+from datetime import datetime
+import pandas as pd
+from util.scrape import WorkSearch, get_search_mod, scrape_fic_list
+
+
+def sort_by_revised(search_url):
+    '''
+    {search_url} with its results sorted by last revision, newest first.
+    '''
+    url = re.sub(r"&work_search\[sort_(column|direction)\]=[^&]*", "", search_url)
+    return url + get_search_mod("sort_column", "revised_at") + get_search_mod("sort_direction", "desc")
+
+def parse_date(date):
+    '''
+    A blurb's date, e.g. "07 Nov 2020", or None if it cannot be read.
+    '''
+    try:
+        return datetime.strptime(date, "%d %b %Y")
+    except (TypeError, ValueError):
+        return None
+
+
+def ingest_updates(search_url, stored_df, stop_after=20, single_only=False, word_range=(0,0), include_adult=False, exclude_series=True, workers=1, fetcher=None, backend="bs4", changelog_path=None, print_every=0):
+    '''
+    Refresh {stored_df}, a previous scrape of {search_url}, by scraping only
+    works that are new or whose date or chapter count changed. The search is
+    paged sorted by last revision, whatever order {search_url} asks for, and
+    paging stops after {stop_after} consecutive unchanged works.
+
+    Returns the refreshed DataFrame, with the works reached in search order
+    first, and a changelog of added, updated, and removed work_ids, which is also
+    appended to {changelog_path} as a JSON line if given. Removed works are
+    stored works revised after the point where paging stopped that no
+    longer appear in the results.
+    '''
+    stored = dict(zip(stored_df["work_id"], zip(stored_df["date"], stored_df["chapters"])))
+    stored_order = list(stored_df["work_id"])
+
+    search = WorkSearch(sort_by_revised(search_url), single_only=single_only, word_range=word_range, include_adult=include_adult, exclude_series=exclude_series, print_every=print_every, fetcher=fetcher, backend=backend)
+
+    seen = []
+    seen_set = set()
+    changed = []
+    unchanged_run = 0
+    last_unchanged = None
+    stopped_early = False
+
+    for info in search:
+        work_id = info["work_id"]
+        # results shift while we page, so the same work can show up twice
+        if work_id in seen_set:
+            continue
+        seen.append(work_id)
+        seen_set.add(work_id)
+        if stored.get(work_id) == (info["date"], info["chapters"]):
+            unchanged_run += 1
+            last_unchanged = work_id
+            if unchanged_run >= stop_after:
+                stopped_early = True
+                break
+        else:
+            changed.append(info)
+            unchanged_run = 0
+
+    removed = [work_id for work_id in stored_order if work_id not in seen_set]
+    if stopped_early:
+        # works revised before the boundary were simply not reached
+        boundary = parse_date(stored[last_unchanged][0])
+        removed = [work_id for work_id in removed if boundary is not None and (parse_date(stored[work_id][0]) or boundary) > boundary]
+
+    if print_every:
+        print(f"{len(changed)} new or updated works, {len(removed)} removed")
+
+    scraped_df = pd.DataFrame()
+    if changed:
+        scraped_df = scrape_fic_list(changed, print_every=print_every, workers=workers, fetcher=search.fetcher, backend=backend)
+
+    # works that failed to scrape keep their stored row and are retried next time
+    scraped_ids = set(scraped_df["work_id"]) if len(scraped_df) else set()
+    added = [info["work_id"] for info in changed if info["work_id"] in scraped_ids and info["work_id"] not in stored]
+    updated = [info["work_id"] for info in changed if info["work_id"] in scraped_ids and info["work_id"] in stored]
+
+    dropped = set(updated) | set(removed)
+    kept_df = stored_df[~stored_df["work_id"].isin(dropped)]
+    merged = pd.concat([scraped_df, kept_df], ignore_index=True).set_index("work_id")
+
+    # crawled works in search order, then the stored works we did not reach
+    order = [work_id for work_id in seen if work_id in merged.index]
+    order_set = set(order)
+    order += [work_id for work_id in stored_order if work_id not in order_set and work_id in merged.index]
+    new_df = merged.loc[order].reset_index()
+
+    changelog = {"time": datetime.now().isoformat(), "added": added, "updated": updated, "removed": removed, "stopped_early": stopped_early}
+    if changelog_path:
+        with open(changelog_path, "a") as f:
+            f.write(json.dumps(changelog) + "\n")
+
+    return new_df, changelog
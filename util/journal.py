@@ -0,0 +1,145 @@
+'''
+# Crash-safe journal of scraped works.
+#
+# Andrew Zhou
+#
+# Each work is appended to the open shard as one JSON line and fsynced as
+# soon as it has been scraped. Full shards are sealed by an atomic rename, so
+# a crash can at worst leave a torn last line in the open shard, which is
+# dropped on recovery.
+'''
+
+import json
+import os
+import re
+import threading
+import pandas as pd
+
+SHARD_RE = re.compile(r"part-(\d+)\.jsonl(\.open)?$")
+
+
+class ScrapeJournal():
+    '''
+    Append-only, sharded JSONL journal of scraped works, with an in-memory
+    set of completed work_ids for O(1) resume checks.
+    '''
+    def __init__(self, directory, shard_size=200):
+        self.directory = directory
+        self.shard_size = shard_size
+        self.done = set()
+        self.lock = threading.Lock()
+        self.file = None
+        self.shard = 0
+        self.shard_count = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+
+    def shard_path(self, shard, sealed=True):
+        return os.path.join(self.directory, f"part-{shard:05d}.jsonl" + ("" if sealed else ".open"))
+
+    def list_shards(self):
+        shards = []
+        for name in os.listdir(self.directory):
+            match = SHARD_RE.match(name)
+            if match:
+                shards.append((int(match.group(1)), os.path.join(self.directory, name)))
+        return [path for _, path in sorted(shards)]
+
+    @staticmethod
+    def read_shard(path):
+        '''
+        Read the records in a shard, skipping a torn final line.
+        '''
+        records = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+        return records
+
+    def recover(self):
+        '''
+        Rebuild the index of completed works, and seal any shard that was left
+        open by a crash after rewriting it without its torn last line.
+        '''
+        for path in self.list_shards():
+            records = self.read_shard(path)
+            self.done.update(record["work_id"] for record in records)
+            shard = int(SHARD_RE.search(path).group(1))
+            self.shard = max(self.shard, shard + 1)
+
+            if path.endswith(".open"):
+                tmp = path + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    for record in records:
+                        f.write(json.dumps(record) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.shard_path(shard))
+                os.remove(path)
+
+    def __contains__(self, work_id):
+        return work_id in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def append(self, record):
+        '''
+        Durably append a scraped work.
+        '''
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.shard_path(self.shard, sealed=False), "a", encoding="utf-8")
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.done.add(record["work_id"])
+
+            self.shard_count += 1
+            if self.shard_count >= self.shard_size:
+                self.seal()
+
+    def seal(self):
+        '''
+        Close the open shard and atomically rename it into place.
+        '''
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        os.replace(self.shard_path(self.shard, sealed=False), self.shard_path(self.shard))
+        self.shard += 1
+        self.shard_count = 0
+
+    def close(self):
+        with self.lock:
+            self.seal()
+
+    def to_dataframe(self):
+        '''
+        Compact every shard into a single DataFrame, keeping the latest record
+        of each work.
+        '''
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+            records = [record for path in self.list_shards() for record in self.read_shard(path)]
+        df = pd.DataFrame(records)
+        if len(df):
+            df = df.drop_duplicates("work_id", keep="last").reset_index(drop=True)
+        return df
+
+    def compact(self, path=None):
+        '''
+        Seal the open shard and return the compacted DataFrame, pickling it to
+        {path} if given.
+        '''
+        self.close()
+        df = self.to_dataframe()
+        if path:
+            df.to_pickle(path)
+        return df
@@ -9,20 +9,58 @@
 '''
 #
 
-from gensim.models import LdaModel
-from gensim.corpora import Dictionary
+from gensim.models import LdaModel, LdaMulticore
+from gensim.corpora import Dictionary, MmCorpus
 from gensim.models import CoherenceModel
 import logging
+import copy
+import json
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from util.corpus import TokenCorpus
+from util.coherence import CoherenceEvaluator
+from util.doc_topics import infer_topics, save_doc_topics
+
+# Per-worker state for the tuning pool, sent once per worker process
+worker_state = {}
 
 class LDATuner():
     '''
     Class to train and tune the LDA topic model.
+
+    docs is a list of processed documents, or a TokenCorpus, in which case
+    the Dictionary and bag-of-words corpus are built from its token ids.
+
+    If corpus_file is given, each bag-of-words corpus is streamed to disk in
+    Matrix Market format at {corpus_file}_{min_thresh}_{max_thresh}.mm and
+    models are trained from that file, so the corpus is never held in
+    memory. With workers > 1, models are trained with LdaMulticore, which
+    does not support alpha='auto'; those fall back to LdaModel.
+
+    If fast_coherence is set, c_v coherence is computed by a
+    CoherenceEvaluator, which keeps its window counts between models, and
+    tune_hyper scores every configuration after a single scan of the docs.
     '''
-    def __init__(self, docs, corpus_file=None, print_progress=True, verbose=True):
+    def __init__(self, docs, corpus_file=None, print_progress=True, verbose=True, workers=1, fast_coherence=False):
         self.docs = docs
+        self.corpus_file = corpus_file
+        self.workers = workers
+        self.evaluator = CoherenceEvaluator(docs, n_jobs=workers) if fast_coherence else None
+        # processes for gensim's CoherenceModel, -1 for all but one core
+        self.coherence_processes = -1
+        # Dictionary of the whole corpus, and (dictionary, corpus) filtered
+        # for each (min_thresh, max_thresh), built once and shared by every
+        # configuration that uses them
+        self.raw_dictionary = None
+        self.filtered = {}
         self.dictionary = None
         self.corpus = None
         self.model = None
+        self.doc_topics = None
         self.print_progress = print_progress
 
         if verbose:
@@ -32,16 +70,24 @@ class LDATuner():
         '''
         Train a model with the provided parameters, and optionally save as private variables.
         '''
-        dictionary = Dictionary(self.docs)
-        dictionary.filter_extremes(no_below=min_thresh, no_above=max_thresh)
+        dictionary, corpus = self.get_dictionary_corpus(min_thresh, max_thresh)
+        model = self.make_model(corpus, dictionary, num_topics=num_topics, chunksize=chunksize, alpha=alpha, beta=beta, iterations=iterations, passes=passes, eval_every=eval_every, random_state=random_state)
+
+        if save_model:
+            self.dictionary = dictionary
+            self.model = model
+            self.corpus = corpus
+            self.doc_topics = None
         
-        temp = dictionary[0]  # This is only to "load" the dictionary.
-        id2word = dictionary.id2token
-        corpus = [dictionary.doc2bow(doc) for doc in self.docs]
+        return model, dictionary, corpus
 
-        model = LdaModel(
+    def make_model(self, corpus, dictionary, num_topics=5, chunksize=2000, alpha='auto', beta='auto', iterations=400, passes=20, eval_every=None, random_state=0):
+        '''
+        Train an LdaModel (or LdaMulticore, with workers > 1) on {corpus}.
+        '''
+        kwargs = dict(
             corpus=corpus,
-            id2word=id2word,
+            id2word=dictionary.id2token,
             chunksize=chunksize,
             alpha=alpha,
             eta=beta,
@@ -51,37 +97,223 @@ class LDATuner():
             eval_every=eval_every,
             random_state=random_state
         )
+        if self.workers > 1 and alpha != 'auto':
+            return LdaMulticore(**kwargs, workers=self.workers)
+        return LdaModel(**kwargs)
 
-        if save_model:
-            self.dictionary = dictionary
-            self.model = model
-            self.corpus = corpus
-        
-        return model, dictionary, corpus
+    def get_dictionary_corpus(self, min_thresh=0, max_thresh=1.0):
+        '''
+        The filtered Dictionary and bag-of-words corpus for the given
+        thresholds, built on first use and cached after that.
+        '''
+        key = (min_thresh, max_thresh)
+        if key not in self.filtered:
+            if self.raw_dictionary is None:
+                if isinstance(self.docs, TokenCorpus):
+                    self.raw_dictionary = self.docs.to_dictionary()
+                else:
+                    self.raw_dictionary = Dictionary(self.docs)
+
+            dictionary = copy.deepcopy(self.raw_dictionary)
+            dictionary.filter_extremes(no_below=min_thresh, no_above=max_thresh)
+            temp = dictionary[0]  # This is only to "load" the dictionary.
+            if isinstance(self.docs, TokenCorpus):
+                corpus = self.docs.bow_corpus(dictionary)
+            else:
+                corpus = (dictionary.doc2bow(doc) for doc in self.docs)
+
+            if self.corpus_file:
+                # written one document at a time, then read back as a stream
+                path = self.get_corpus_path(min_thresh, max_thresh)
+                MmCorpus.serialize(path, corpus, id2word=dictionary)
+                corpus = MmCorpus(path)
+            else:
+                corpus = list(corpus)
+            self.filtered[key] = (dictionary, corpus)
+        return self.filtered[key]
+
+    def get_corpus_path(self, min_thresh=0, max_thresh=1.0):
+        return f"{self.corpus_file}_{min_thresh}_{max_thresh}.mm"
+
+    def __getstate__(self):
+        # reopen serialized corpora from their files rather than pickling them
+        state = dict(self.__dict__)
+        if self.corpus_file:
+            state["filtered"] = {key: (dictionary, None) for key, (dictionary, _) in self.filtered.items()}
+            state["corpus"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.corpus_file:
+            self.filtered = {key: (dictionary, MmCorpus(self.get_corpus_path(*key))) for key, (dictionary, _) in self.filtered.items()}
     
-    def tune_hyper(self, keywords, param_grid, iterations=400, passes=20):
+    def tune_hyper(self, keywords, param_grid, iterations=400, passes=20, n_jobs=1, random_state=0):
         '''
         Give a list of keywords and a parameter grid (as an itertools product),
         trains a model for each set of parameters, storing and returning the 
         coherence scores for each model.
+
+        The Dictionary and corpus for each (min_thresh, max_thresh) are built
+        once for the whole grid. With n_jobs > 1 (or -1 for every core), the
+        configurations are trained in a process pool. Each one is trained
+        exactly as in the serial run (with LdaMulticore if workers > 1, so
+        the pool can use up to n_jobs * workers cores) and with the same
+        random_state, so the scores match the serial run.
         '''
-        count = 0
+        param_grid = list(param_grid)
         model_scores = {}
         if self.print_progress:
             print(f"beginning parameter evaluation...")
-        
+
+        if n_jobs == 1:
+            for count, params in enumerate(param_grid, 1):
+                model_scores[params] = self.score_params(params, keywords, iterations, passes, random_state)
+                if self.print_progress:
+                    print(f"trained model {count} with params {dict(zip(keywords, params))}") 
+                    if self.evaluator is None:
+                        print(f"coherence {model_scores[params]}")
+            return self.score_topics(model_scores)
+
+        if n_jobs < 0:
+            n_jobs = os.cpu_count()
+        # build every filtered corpus here, so each worker receives them once
         for params in param_grid:
             kwargs = dict(zip(keywords, params))
+            self.get_dictionary_corpus(kwargs.get("min_thresh", 0), kwargs.get("max_thresh", 1.0))
 
-            count += 1
+        items = [(params, keywords, iterations, passes, random_state) for params in param_grid]
+        # unlike multiprocessing.Pool's, these workers may start processes of
+        # their own, as LdaMulticore does
+        with ProcessPoolExecutor(min(n_jobs, len(items)) or 1, initializer=init_tune_worker, initargs=(self,)) as executor:
+            futures = [executor.submit(tune_worker, item) for item in items]
+            for count, future in enumerate(as_completed(futures), 1):
+                params, score = future.result()
+                model_scores[params] = score
+                if self.print_progress:
+                    print(f"trained model {count}/{len(items)} with params {dict(zip(keywords, params))}")
+                    if self.evaluator is None:
+                        print(f"coherence {score}")
+        # in grid order, as in the serial run
+        return self.score_topics({params: model_scores[params] for params in param_grid})
 
-            model, dictionary, _ = self.train_model(**kwargs, iterations=iterations, passes=passes, random_state=0, save_model=False)
+    def score_params(self, params, keywords, iterations=400, passes=20, random_state=0):
+        '''
+        Train a model with the given parameters without saving it, and return
+        its coherence, or with fast_coherence its topics, to be scored later
+        by score_topics together with every other model.
+        '''
+        kwargs = dict(zip(keywords, params))
+        model, dictionary, _ = self.train_model(**kwargs, iterations=iterations, passes=passes, random_state=random_state, save_model=False)
+        if self.evaluator is not None:
+            return self.evaluator.get_topics(model)
+        return self.get_coherence(model=model, dictionary=dictionary)
 
-            model_scores[params] = self.get_coherence(model=model, dictionary=dictionary)
+    def score_topics(self, model_results):
+        '''
+        Replace the topics returned by score_params with coherence scores,
+        counting the windows for all the models at once.
+        '''
+        if self.evaluator is None:
+            return model_results
+        scores = self.evaluator.score_many(list(model_results.values()))
+        if self.print_progress:
+            print(f"scored {len(scores)} models")
+        return dict(zip(model_results, scores))
+
+    def tune_halving(self, keywords, param_grid, min_passes=2, max_passes=20, reduction_factor=3, iterations=400, metric="coherence", holdout=0.1, random_state=0):
+        '''
+        Successive halving over a parameter grid in the same format as
+        tune_hyper. Every configuration is trained for {min_passes} passes
+        and scored; the best 1/{reduction_factor} of them are trained on, from
+        where they left off, to {reduction_factor} times as many passes, and
+        so on until {max_passes}.
+
+        {metric} is "coherence" (c_v) or "perplexity", the per-word
+        likelihood bound on a random {holdout} fraction of documents (at
+        least one, drawn with {random_state}), which are then left out of
+        training. The best
+        model is saved as with train_model, with the full Dictionary and
+        corpus. Returns the last score of every configuration and a
+        summary of each round and of the passes saved against the full grid.
+        '''
+        param_grid = list(param_grid)
+        candidates = []
+        is_test = None
+        for params in param_grid:
+            kwargs = dict(zip(keywords, params))
+            thresholds = (kwargs.pop("min_thresh", 0), kwargs.pop("max_thresh", 1.0))
+            dictionary, corpus = self.get_dictionary_corpus(*thresholds)
+            test = []
+            if metric == "perplexity":
+                corpus = list(corpus)
+                if is_test is None:
+                    n_test = max(1, int(len(corpus) * holdout))
+                    if n_test >= len(corpus):
+                        raise ValueError(f"cannot hold out {n_test} of {len(corpus)} documents and still train on any")
+                    # the same documents are held out for every configuration
+                    is_test = np.zeros(len(corpus), dtype=bool)
+                    is_test[np.random.default_rng(random_state).choice(len(corpus), n_test, replace=False)] = True
+                test = [bow for bow, held_out in zip(corpus, is_test) if held_out]
+                corpus = [bow for bow, held_out in zip(corpus, is_test) if not held_out]
+                if not any(bow for bow in test):
+                    raise ValueError(f"the held-out documents have no words left after filtering with {thresholds}; raise holdout")
+            model = self.make_model(corpus, dictionary, **kwargs, iterations=iterations, passes=min_passes, random_state=random_state)
+            candidates.append({"params": params, "model": model, "thresholds": thresholds, "corpus": corpus, "test": test})
+
+        model_scores = {}
+        rounds = []
+        passes_done = min_passes
+        passes_trained = min_passes * len(candidates)
+        while True:
+            if metric == "perplexity":
+                scores = [c["model"].log_perplexity(c["test"]) for c in candidates]
+            elif self.evaluator is not None:
+                scores = self.evaluator.score_many([self.evaluator.get_topics(c["model"]) for c in candidates])
+            else:
+                scores = [self.get_coherence(model=c["model"], dictionary=self.get_dictionary_corpus(*c["thresholds"])[0]) for c in candidates]
+            for c, score in zip(candidates, scores):
+                c["score"] = model_scores[c["params"]] = score
+            candidates.sort(key=lambda c: c["score"], reverse=True)
+            rounds.append({"passes": passes_done, "candidates": len(candidates), "best": candidates[0]["params"], "best_score": candidates[0]["score"]})
             if self.print_progress:
-                print(f"trained model {count} with params {kwargs}") 
-                print(f"coherence {model_scores[params]}")
-        return model_scores
+                print(f"{len(candidates)} models at {passes_done} passes, best {candidates[0]['params']} with {metric} {candidates[0]['score']}")
+            if passes_done >= max_passes:
+                break
+
+            candidates = candidates[:max(1, len(candidates) // reduction_factor)]
+            next_passes = min(passes_done * reduction_factor, max_passes)
+            for c in candidates:
+                c["model"].update(c["corpus"], passes=next_passes - passes_done)
+            passes_trained += (next_passes - passes_done) * len(candidates)
+            passes_done = next_passes
+
+        best = candidates[0]
+        # the whole corpus, not just the documents trained on
+        self.dictionary, self.corpus = self.get_dictionary_corpus(*best["thresholds"])
+        self.model = best["model"]
+        self.doc_topics = None
+
+        full_grid_passes = max_passes * len(param_grid)
+        summary = {
+            "rounds": rounds,
+            "best": best["params"],
+            "passes_trained": passes_trained,
+            "full_grid_passes": full_grid_passes,
+            "saved": 1 - passes_trained / full_grid_passes if full_grid_passes else 0.0,
+        }
+        if self.print_progress:
+            print(f"trained {passes_trained} passes instead of {full_grid_passes}, saving {summary['saved']:.0%}")
+        return model_scores, summary
+
+    @staticmethod
+    def scores_table(model_scores, keywords):
+        '''
+        Tabulate the scores returned by tune_hyper, one row per configuration,
+        best first.
+        '''
+        rows = [dict(zip(keywords, params), coherence=score) for params, score in model_scores.items()]
+        return pd.DataFrame(rows).sort_values("coherence", ascending=False).reset_index(drop=True)
     
     def train_model_params(self, params, keywords, iterations=500, passes=30):
         '''
@@ -94,10 +326,29 @@ class LDATuner():
         model, dictionary, corpus = self.train_model(**kwargs, iterations=iterations, passes=passes, random_state=0)
         coherence = self.get_coherence()
         
-        model_info = {"model": model, "dict": dictionary, "corpus": corpus, "coherence": coherence}
+        model_info = {"model": model, "dict": dictionary, "corpus": corpus, "coherence": coherence, "doc_topics": self.get_doc_topics()}
         
         return model_info        
         
+    def get_doc_topics(self, path=None):
+        '''
+        The (n_docs, num_topics) float32 document-topic matrix of the trained
+        model, inferred once and optionally saved as a .npy file at {path}
+        to be memory-mapped with load_doc_topics.
+        '''
+        if self.doc_topics is None:
+            self.doc_topics = infer_topics(self.model, self.corpus)
+        if path:
+            save_doc_topics(path, self.doc_topics)
+        return self.doc_topics
+
+    def save_model_version(self, directory):
+        '''
+        Save the trained model and its document-topic matrix as a new version
+        in {directory}, as a fully trained base for update_model.
+        '''
+        return save_version(directory, self.model, self.dictionary, doc_topics=self.get_doc_topics(), kind="train", trained_docs=self.dictionary.num_docs)
+
     def get_coherence(self, model=None, dictionary=None, texts=None):
         '''
         Get the model coherence, as measured by the c_v metric
@@ -107,8 +358,156 @@ class LDATuner():
         if not dictionary:
             dictionary = self.dictionary
         if not texts:
+            if self.evaluator is not None:
+                return self.evaluator.score(model)
             texts = self.docs
-        coherence_model_lda = CoherenceModel(model=model, texts=texts, dictionary=dictionary, coherence='c_v')
+        coherence_model_lda = CoherenceModel(model=model, texts=texts, dictionary=dictionary, coherence='c_v', processes=self.coherence_processes)
         coherence_lda = coherence_model_lda.get_coherence()
         return coherence_lda
 
+
+def init_tune_worker(tuner):
+    tuner.print_progress = False
+    # coherence counts come out the same in one process, and the pool
+    # already keeps the cores busy
+    tuner.coherence_processes = 1
+    if tuner.evaluator is not None:
+        tuner.evaluator.n_jobs = 1
+    worker_state.update(tuner=tuner)
+
+def tune_worker(item):
+    params, keywords, iterations, passes, random_state = item
+    return params, worker_state["tuner"].score_params(params, keywords, iterations, passes, random_state)
+
+
+def list_versions(directory):
+    '''
+    The metadata of every model version saved in {directory}, oldest first.
+    '''
+    versions = []
+    if os.path.isdir(directory):
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name, "meta.json")
+            if name.startswith("v") and os.path.exists(path):
+                with open(path, "r") as f:
+                    versions.append(json.load(f))
+    return versions
+
+def save_version(directory, model, dictionary, parent=None, doc_topics=None, **info):
+    '''
+    Save a model and its Dictionary (and document-topic matrix, if given) as
+    the next version in {directory} (v0001, v0002, ...), with metadata
+    recording the version it was derived from and anything passed in
+    {info}. The version directory is written under a temporary name and
+    renamed, so readers never see half of it.
+    '''
+    versions = list_versions(directory)
+    version = versions[-1]["version"] + 1 if versions else 1
+    path = os.path.join(directory, f"v{version:04d}")
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    model.save(os.path.join(tmp, "lda.model"))
+    dictionary.save(os.path.join(tmp, "dictionary.dict"))
+    if doc_topics is not None:
+        save_doc_topics(os.path.join(tmp, "doc_topics.npy"), doc_topics)
+    meta = {"version": version, "parent": parent, "created": time.time(), "num_docs": dictionary.num_docs, "num_terms": len(dictionary), "num_topics": model.num_topics}
+    meta.update(info)
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    os.rename(tmp, path)
+    return meta
+
+def load_version(directory, version=None):
+    '''
+    Load (model, dictionary, metadata) of a saved version, the latest by
+    default.
+    '''
+    if version is None:
+        versions = list_versions(directory)
+        if not versions:
+            raise FileNotFoundError(f"no model versions in {directory}")
+        version = versions[-1]["version"]
+    path = os.path.join(directory, f"v{version:04d}")
+    with open(os.path.join(path, "meta.json"), "r") as f:
+        meta = json.load(f)
+    model = LdaModel.load(os.path.join(path, "lda.model"))
+    dictionary = Dictionary.load(os.path.join(path, "dictionary.dict"))
+    return model, dictionary, meta
+
+def extend_vocabulary(model, dictionary):
+    '''
+    Grow a trained model's topic-word statistics to cover tokens added to
+    its Dictionary since training. New words start with no counts, only the
+    mean prior, so they enter topics as documents using them are folded in.
+    '''
+    num_new = len(dictionary) - model.num_terms
+    if num_new <= 0:
+        return model
+
+    def pad(prior):
+        prior = np.asarray(prior)
+        extra = np.full(prior.shape[:-1] + (num_new,), prior.mean(), dtype=prior.dtype)
+        return np.concatenate([prior, extra], axis=-1)
+
+    model.eta = pad(model.eta)
+    model.state.eta = pad(model.state.eta)
+    model.state.sstats = np.hstack([model.state.sstats, np.zeros((model.num_topics, num_new), dtype=model.state.sstats.dtype)])
+    model.num_terms = len(dictionary)
+    model.id2word = dictionary
+    model.sync_state()
+    return model
+
+def topic_drift(before, after):
+    '''
+    Hellinger distance between each topic's word distribution before and
+    after an update, over the words of the earlier vocabulary.
+    '''
+    after = after[:, :before.shape[1]]
+    after = after / after.sum(axis=1, keepdims=True)
+    return np.sqrt(0.5 * ((np.sqrt(before) - np.sqrt(after)) ** 2).sum(axis=1))
+
+def update_model(directory, new_docs, min_df=5, max_new_tokens=5000, passes=1, drift_threshold=0.15, max_update_fraction=0.5, print_progress=True):
+    '''
+    Fold newly ingested, processed documents into the latest model version
+    in {directory} with online LDA updates, instead of retraining, and save
+    the result as a new version.
+
+    Tokens the Dictionary has not seen are added only if they appear in at
+    least {min_df} of the new documents, at most the {max_new_tokens} most
+    common. The Hellinger distance between each topic before and after the
+    update is recorded, and added up over the updates since the last full
+    training; the new version is flagged needs_retrain once that passes
+    {drift_threshold}, or once updates have added more than
+    {max_update_fraction} of the documents the model was trained on.
+    '''
+    model, dictionary, parent = load_version(directory)
+    new_docs = list(new_docs)
+
+    new_tokens = Dictionary(new_docs)
+    new_tokens.filter_tokens(good_ids=[token_id for token_id, df in new_tokens.dfs.items() if df >= min_df and new_tokens[token_id] not in dictionary.token2id])
+    new_tokens.filter_extremes(no_below=0, no_above=1.0, keep_n=max_new_tokens)
+    accepted = set(new_tokens.token2id)
+    known = dictionary.token2id
+    dictionary.add_documents([[token for token in doc if token in known or token in accepted] for doc in new_docs])
+
+    before = model.get_topics()
+    extend_vocabulary(model, dictionary)
+    corpus = [dictionary.doc2bow(doc) for doc in new_docs]
+    model.update(corpus, passes=passes)
+    drift = topic_drift(before, model.get_topics())
+
+    trained_docs = parent.get("trained_docs", parent["num_docs"])
+    updated_docs = parent.get("updated_docs", 0) + len(new_docs)
+    drift_since_retrain = parent.get("drift_since_retrain", 0.0) + float(drift.mean())
+    needs_retrain = drift_since_retrain > drift_threshold or updated_docs > max_update_fraction * trained_docs
+
+    meta = save_version(directory, model, dictionary, parent=parent["version"], kind="update", new_docs=len(new_docs), new_tokens=len(accepted),
+                        drift=float(drift.mean()), max_drift=float(drift.max()), drift_since_retrain=drift_since_retrain,
+                        trained_docs=trained_docs, updated_docs=updated_docs, needs_retrain=needs_retrain)
+    if print_progress:
+        print(f"saved version {meta['version']}: {len(new_docs)} documents, {len(accepted)} new tokens, mean topic drift {meta['drift']:.3f}")
+        if needs_retrain:
+            print(f"drift since the last full training is {drift_since_retrain:.3f}; a full retrain is recommended")
+    return model, dictionary, meta
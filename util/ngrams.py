@@ -0,0 +1,252 @@
+'''
+# Compiled n-gram matching and streaming n-gram counting for preprocessing.
+#
+# Andrew Zhou
+#
+# The ngrams config (bigrams, trigrams, and exceptions) is compiled once into
+# a token trie, so merging a document is a single pass of dict lookups
+# instead of joining and scanning lists at every position.
+'''
+
+import random
+import time
+from collections import Counter
+
+# bits per token id when packing bigrams and trigrams into a single int key
+ID_BITS = 32
+ID_MASK = (1 << ID_BITS) - 1
+
+# trie node layout: [children, exception value, phrase if in trigrams, phrase if in bigrams]
+CHILDREN, EXCEPTION, TRIGRAM, BIGRAM = range(4)
+MISSING = object()
+
+
+class NgramMatcher():
+    '''
+    Token trie built from an ngrams config, for merge_ngrams.
+    '''
+    def __init__(self, ngrams):
+        self.config = ngrams
+        self.root = {}
+        for phrase, value in ngrams.get("exceptions", {}).items():
+            self.get_node(phrase)[EXCEPTION] = value
+        for phrase in ngrams.get("trigrams", []):
+            self.get_node(phrase)[TRIGRAM] = phrase
+        for phrase in ngrams.get("bigrams", []):
+            self.get_node(phrase)[BIGRAM] = phrase
+
+    def get_node(self, phrase):
+        # merge_ngrams joins tokens with single spaces, so split the same way
+        children = self.root
+        for token in phrase.split(' '):
+            if token not in children:
+                children[token] = [{}, MISSING, None, None]
+            node = children[token]
+            children = node[CHILDREN]
+        return node
+
+    def merge(self, doc_lemm, stop_after=()):
+        '''
+        Same output as merge_ngrams_naive: at each position, try trigram,
+        bigram, and unigram exceptions, then trigrams, then bigrams. Near the
+        end of the document the "trigram" and "bigram" are just the tokens
+        that are left, as with slicing.
+        '''
+        stop_after = set(stop_after)
+        root = self.root
+        merged = []
+        n = len(doc_lemm)
+        i = 0
+        while i < n:
+            uni = doc_lemm[i]
+            node_1 = root.get(uni)
+            if node_1 is None:
+                if uni not in stop_after:
+                    merged.append(uni)
+                i += 1
+                continue
+
+            node_2 = node_1[CHILDREN].get(doc_lemm[i+1]) if i + 1 < n else node_1
+            node_3 = (node_2[CHILDREN].get(doc_lemm[i+2]) if i + 2 < n else node_2) if node_2 is not None else None
+
+            if node_3 is not None and node_3[EXCEPTION] is not MISSING:
+                merged.append(node_3[EXCEPTION])
+                i += 3
+            elif node_2 is not None and node_2[EXCEPTION] is not MISSING:
+                merged.append(node_2[EXCEPTION])
+                i += 2
+            elif node_1[EXCEPTION] is not MISSING:
+                merged.append(node_1[EXCEPTION])
+                i += 1
+            elif node_3 is not None and node_3[TRIGRAM] is not None:
+                merged.append(node_3[TRIGRAM])
+                i += 3
+            elif node_2 is not None and node_2[BIGRAM] is not None:
+                merged.append(node_2[BIGRAM])
+                i += 2
+            else:
+                if uni not in stop_after:
+                    merged.append(uni)
+                i += 1
+        return merged
+
+
+class NgramCounter():
+    '''
+    Streaming bigram and trigram counter. Tokens are mapped to integer ids
+    and both n-gram orders are counted in a single pass over each document,
+    skipping any n-gram that contains a stopword, so the tokenized corpus
+    never needs to be kept around.
+
+    Counters from separate shards can be combined with merge. If {max_size}
+    is set, n-grams seen fewer than an increasing threshold are pruned
+    whenever either table grows past it, which bounds memory at the cost of
+    undercounting rare n-grams.
+    '''
+    def __init__(self, stopwords=(), max_size=None):
+        self.stopwords = set(stopwords)
+        self.max_size = max_size
+        self.prune_at = 2
+        self.vocab = {}
+        self.tokens = []
+        self.is_stop = []
+        self.bigrams = Counter()
+        self.trigrams = Counter()
+
+    def token_id(self, token):
+        token_id = self.vocab.get(token)
+        if token_id is None:
+            token_id = len(self.tokens)
+            self.vocab[token] = token_id
+            self.tokens.append(token)
+            self.is_stop.append(token in self.stopwords)
+        return token_id
+
+    def add(self, tokens):
+        '''
+        Count the n-grams of one tokenized document.
+        '''
+        vocab = self.vocab
+        is_stop = self.is_stop
+        bigrams = self.bigrams
+        trigrams = self.trigrams
+
+        # the previous two ids in the current run of non-stopwords, or -1
+        prev_1 = prev_2 = -1
+        for token in tokens:
+            token_id = vocab.get(token)
+            if token_id is None:
+                token_id = self.token_id(token)
+            if is_stop[token_id]:
+                prev_1 = prev_2 = -1
+                continue
+            if prev_1 >= 0:
+                bigrams[prev_1 << ID_BITS | token_id] += 1
+                if prev_2 >= 0:
+                    trigrams[(prev_2 << ID_BITS | prev_1) << ID_BITS | token_id] += 1
+            prev_2, prev_1 = prev_1, token_id
+
+        if self.max_size and max(len(bigrams), len(trigrams)) > self.max_size:
+            self.prune(self.prune_at)
+            self.prune_at += 1
+
+    def prune(self, min_count):
+        '''
+        Drop n-grams seen fewer than {min_count} times.
+        '''
+        for counts in (self.bigrams, self.trigrams):
+            for key in [key for key, count in counts.items() if count < min_count]:
+                del counts[key]
+
+    def merge(self, other):
+        '''
+        Add the counts of another counter, e.g. from a parallel shard.
+        '''
+        remap = [self.token_id(token) for token in other.tokens]
+        for key, count in other.bigrams.items():
+            self.bigrams[remap[key >> ID_BITS] << ID_BITS | remap[key & ID_MASK]] += count
+        for key, count in other.trigrams.items():
+            first, second, third = remap[key >> 2 * ID_BITS], remap[key >> ID_BITS & ID_MASK], remap[key & ID_MASK]
+            self.trigrams[(first << ID_BITS | second) << ID_BITS | third] += count
+        return self
+
+    def to_counters(self):
+        '''
+        Return Counters of bigram and trigram token tuples.
+        '''
+        tokens = self.tokens
+        c_bi = Counter({(tokens[key >> ID_BITS], tokens[key & ID_MASK]): count for key, count in self.bigrams.items()})
+        c_tri = Counter({(tokens[key >> 2 * ID_BITS], tokens[key >> ID_BITS & ID_MASK], tokens[key & ID_MASK]): count for key, count in self.trigrams.items()})
+        return c_bi, c_tri
+
+
+def merge_ngrams_naive(doc_lemm, ngrams, stop_after):
+    '''
+    The original list-scanning merge, kept as the reference for NgramMatcher.
+    '''
+    doc_lemm_grams = []
+
+    bigrams = ngrams["bigrams"] if "bigrams" in ngrams else []
+    trigrams = ngrams["trigrams"] if "trigrams" in ngrams else []
+    exceptions_dict = ngrams["exceptions"] if "exceptions" in ngrams else {}
+
+    i = 0
+    while i < len(doc_lemm):
+        uni = doc_lemm[i]
+        bi = ' '.join(doc_lemm[i:i+2])
+        tri = ' '.join(doc_lemm[i:i+3])
+        if tri in exceptions_dict:
+            doc_lemm_grams.append(exceptions_dict[tri])
+            i += 3
+        elif bi in exceptions_dict:
+            doc_lemm_grams.append(exceptions_dict[bi])
+            i += 2
+        elif uni in exceptions_dict:
+            doc_lemm_grams.append(exceptions_dict[uni])
+            i += 1
+        elif tri in trigrams:
+            doc_lemm_grams.append(tri)
+            i += 3
+        elif bi in bigrams:
+            doc_lemm_grams.append(bi)
+            i += 2
+        else:
+            if uni not in stop_after:
+                doc_lemm_grams.append(uni)
+            i += 1
+    return doc_lemm_grams
+
+
+def benchmark_merge(n_docs=100, doc_len=5000, vocab_size=5000, n_bigrams=30, n_trigrams=5, n_exceptions=50, seed=0):
+    '''
+    Time the naive and compiled merges on a synthetic corpus sprinkled with
+    configured phrases, check that they agree, and report tokens/sec.
+    '''
+    rng = random.Random(seed)
+    vocab = [f"w{i}" for i in range(vocab_size)]
+    phrases = lambda k, size: [' '.join(rng.sample(vocab, k)) for _ in range(size)]
+    ngrams = {"bigrams": phrases(2, n_bigrams), "trigrams": phrases(3, n_trigrams)}
+    ngrams["exceptions"] = {phrase: phrase.replace(' ', '_') for phrase in phrases(1, n_exceptions // 2) + phrases(2, n_exceptions // 2)}
+    stop_after = rng.sample(vocab, 10)
+
+    inserts = ngrams["bigrams"] + ngrams["trigrams"] + list(ngrams["exceptions"])
+    docs = []
+    for _ in range(n_docs):
+        doc = []
+        while len(doc) < doc_len:
+            doc += rng.choice(inserts).split(' ') if rng.random() < 0.05 else [rng.choice(vocab)]
+        docs.append(doc)
+    n_tokens = sum(map(len, docs))
+
+    start = time.perf_counter()
+    naive = [merge_ngrams_naive(doc, ngrams, stop_after) for doc in docs]
+    naive_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matcher = NgramMatcher(ngrams)
+    compiled = [matcher.merge(doc, stop_after) for doc in docs]
+    compiled_time = time.perf_counter() - start
+
+    results = {"naive_tokens_per_sec": n_tokens / naive_time, "compiled_tokens_per_sec": n_tokens / compiled_time, "identical": naive == compiled}
+    print(f"naive: {results['naive_tokens_per_sec']:,.0f} tokens/sec, compiled: {results['compiled_tokens_per_sec']:,.0f} tokens/sec, identical output: {results['identical']}")
+    return results
@@ -0,0 +1,118 @@
+'''
+# lxml backend for parsing AO3 pages.
+#
+# Andrew Zhou
+#
+# Mirrors the BeautifulSoup parsers in util/scrape.py and returns identical
+# dicts, but builds the tree with libxml2 and selects nodes with XPath, which
+# is much faster on multi-megabyte full-work pages.
+'''
+
+import re
+from lxml import html as lxml_html
+
+
+def has_class(cls):
+    '''
+    XPath predicate matching elements with {cls} among their classes, like
+    BeautifulSoup's class_ argument.
+    '''
+    if " " in cls:
+        return f"normalize-space(@class)='{cls}'"
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {cls} ')"
+
+def find_all(el, cls):
+    return el.xpath(f".//*[{has_class(cls)}]")
+
+def find(el, cls):
+    found = find_all(el, cls)
+    return found[0] if found else None
+
+def find_authors(el):
+    return el.xpath(".//*[contains(concat(' ', normalize-space(@rel), ' '), ' author ')]")
+
+def text(el):
+    return str(el.text_content())
+
+
+def parse_meta_list(info_html):
+    work_id = info_html.get("id").split("_")[1]
+    rating = find(info_html, "rating").get("class").split()[0].split("-")[1]
+    lang = text(find_all(info_html, "language")[1])
+    words = int(text(find_all(info_html, "words")[1]).replace(",", ""))
+    chapters = int(text(find_all(info_html, "chapters")[1]).split("/")[0])
+    series_html = find(info_html, "series")
+    author_html = find_authors(info_html)
+
+    if author_html:
+        author = text(author_html[0])
+        all_authors = list(map(text, author_html))
+    else:
+        author = "Anonymous"
+        all_authors = []
+
+    series = {}
+    if series_html is not None:
+        match = re.search(r".*Part (\d+) of (.+)", text(series_html))
+        series["part"], series["name"] = match.groups()
+
+    date = text(find(info_html, "datetime"))
+    return {"work_id": work_id, "rating": rating, "lang": lang, "words": words, "chapters": chapters, "date": date, "series": series, "author": author, "all_authors": all_authors}
+
+def chap_html_to_str(chap_html):
+    str_arr = [text(p).replace("\xa0", " ") for p in chap_html.xpath(".//p")]
+    str_arr = [st for st in str_arr if st]
+    return ' '.join(str_arr)
+
+def get_tags(meta_html, cls):
+    tags_html = find_all(meta_html, cls)
+    if len(tags_html) >= 2:
+        return list(map(text, find_all(tags_html[1], "tag")))
+    return []
+
+def parse_meta_fic(meta_html):
+    series = {}
+
+    series_html = find_all(meta_html, "series")
+    if series_html:
+        series_txt = text(find(series_html[1], "position"))
+        match = re.match(r"Part (\d+) of the (.+) series", series_txt)
+        series["part"], series["name"] = match.groups()
+
+    return {"relationships": get_tags(meta_html, "relationship tags"), "chars": get_tags(meta_html, "character tags"), "tags": get_tags(meta_html, "freeform tags"), "series": series}
+
+
+def parse_list_page(html):
+    root = lxml_html.fromstring(html)
+
+    num_found = None
+    for node in root.xpath("//text()"):
+        if re.search(r'\d+ Found', node):
+            num_found = re.match(r'(\d+) Found', str(node)).groups()[0]
+            break
+
+    info_list = root.xpath(f"//*[{has_class('blurb')}]")
+    return num_found, [parse_meta_list(info_html) for info_html in info_list]
+
+def parse_fic_page(html, no_text=False):
+    root = lxml_html.fromstring(html)
+
+    title = text(find(root, "title")).strip()
+
+    authors_html = find_authors(root)
+    if authors_html:
+        author = text(authors_html[0])
+        all_authors = list(map(text, authors_html))
+    else:
+        author = "Anonymous"
+        all_authors = []
+
+    if not no_text:
+        chaps_html = find_all(root.xpath("//div[@id='chapters']")[0], "userstuff")
+        chaps_clean = " ".join(map(chap_html_to_str, chaps_html))
+    else:
+        chaps_clean = ""
+
+    meta_info = parse_meta_fic(find(root, "meta"))
+
+    return {"title": title, "text": chaps_clean, "author": author, "all_authors": all_authors, **meta_info}
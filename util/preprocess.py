@@ -8,12 +8,19 @@
 '''
 
 from nltk.tokenize import word_tokenize
-import spacy
-from nltk.stem import WordNetLemmatizer
-from nltk.corpus import wordnet, stopwords as nltk_stopwords
-from nltk import pos_tag, bigrams as nltk_bigrams, trigrams as nltk_trigrams
+from nltk.corpus import wordnet
 import re
-from collections import Counter
+import os
+import multiprocessing
+import pickle
+import time
+from collections import Counter, OrderedDict
+from util.resources import registry
+from util.ngrams import NgramMatcher, NgramCounter
+from util.doc_cache import ProcessedCache
+
+# Per-worker state for the process pools below, sent once per worker process
+worker_state = {}
 
 def clean(text):
     '''
@@ -40,13 +47,109 @@ def get_wordnet_pos(treebank_tag):
     else:
         return ''
 
-def lemmatize_tokens(tokens, stopwords):
+class LemmaCache():
+    '''
+    Bounded LRU memo of (token, WordNet POS) -> lowercased lemma. Fanfic
+    vocabulary is repetitive, so most lookups are hits and lemmatization cost
+    follows the vocabulary size rather than the corpus size.
+    '''
+    def __init__(self, maxsize=500000):
+        self.maxsize = maxsize
+        self.lemmas = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # lemmas added since the last pop_updates, if tracking (in pool workers)
+        self.new_lemmas = None
+
+    def lemmatize(self, lemmatizer, token, pos):
+        key = (token, pos)
+        lemma = self.lemmas.get(key)
+        if lemma is not None:
+            self.hits += 1
+            self.lemmas.move_to_end(key)
+            return lemma
+
+        self.misses += 1
+        lemma = lemmatizer.lemmatize(token, pos).lower() if pos else lemmatizer.lemmatize(token).lower()
+        self.add(key, lemma)
+        if self.new_lemmas is not None:
+            self.new_lemmas[key] = lemma
+        return lemma
+
+    def add(self, key, lemma):
+        self.lemmas[key] = lemma
+        if len(self.lemmas) > self.maxsize:
+            self.lemmas.popitem(last=False)
+
+    def track_updates(self):
+        '''
+        Start recording new lemmas and lookups, for a copy of the cache in a
+        worker process to send back with pop_updates.
+        '''
+        self.new_lemmas = {}
+        self.hits = 0
+        self.misses = 0
+
+    def pop_updates(self):
+        '''
+        The lemmas added and the hits and misses counted since the last call.
+        '''
+        updates = (self.new_lemmas, self.hits, self.misses)
+        self.track_updates()
+        return updates
+
+    def merge(self, updates):
+        '''
+        Add a worker's updates, from pop_updates, to this cache.
+        '''
+        new_lemmas, hits, misses = updates
+        for key, lemma in new_lemmas.items():
+            if key not in self.lemmas:
+                self.add(key, lemma)
+        self.hits += hits
+        self.misses += misses
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self.lemmas), "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(list(self.lemmas.items()), f)
+
+    @classmethod
+    def load(cls, path, maxsize=500000):
+        '''
+        Load a cache saved by a previous run, or start an empty one if there
+        is none yet.
+        '''
+        cache = cls(maxsize)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                cache.lemmas.update(pickle.load(f))
+        return cache
+
+# Shared by every document processed in this process, unless one is passed in
+default_lemma_cache = LemmaCache()
+
+def lemmatize_tokens(tokens, stopwords, lemma_cache=None):
     '''
     Lemmatize tokens, removing stopwords.
     '''
-    lemmatizer = WordNetLemmatizer()
-    tagged = map(lambda x: (x[0], get_wordnet_pos(x[1])), pos_tag(tokens))
-    lemmas = [lemmatizer.lemmatize(x[0], x[1]).lower() if x[1] else lemmatizer.lemmatize(x[0]).lower() for x in tagged]
+    lemmatizer = registry.get("wordnet_lemmatizer")
+    lemma_cache = lemma_cache if lemma_cache is not None else default_lemma_cache
+    # same as nltk.pos_tag, without reloading the tagger model for every document
+    tagged = map(lambda x: (x[0], get_wordnet_pos(x[1])), registry.get("pos_tagger").tag(tokens))
+    lemmas = [lemma_cache.lemmatize(lemmatizer, x[0], x[1]) for x in tagged]
+    lemmas = [lemma for lemma in lemmas if lemma not in stopwords]
+    return lemmas
+
+def lemmatize_spacy(doc, stopwords):
+    '''
+    Lemmatize a spaCy Doc, removing stopwords.
+    '''
+    # spaCy 2 lemmatizes every pronoun to "-PRON-"
+    lemmas = [token.lower_ if token.lemma_ == "-PRON-" else token.lemma_.lower() for token in doc if not token.is_space]
     lemmas = [lemma for lemma in lemmas if lemma not in stopwords]
     return lemmas
 
@@ -60,82 +163,207 @@ def merge_ngrams(doc_lemm, ngrams, stop_after):
     Also removes stopwords in stop_after, which may be necessary if we 
     have a bigram with a stopword in it that we removed from the stopwords list
     so the bigram could be included.
+
+    ngrams may also be an NgramMatcher already compiled from such a config,
+    which saves recompiling it for every document.
     '''
-    doc_lemm_grams = []
-    
-    bigrams = ngrams["bigrams"] if "bigrams" in ngrams else []
-    trigrams = ngrams["trigrams"] if "trigrams" in ngrams else []
-    exceptions_dict = ngrams["exceptions"] if "exceptions" in ngrams else {}
-    
-    i = 0
-    while i < len(doc_lemm):
-        uni = doc_lemm[i]
-        bi = ' '.join(doc_lemm[i:i+2])
-        tri = ' '.join(doc_lemm[i:i+3])
-        if tri in exceptions_dict:
-            doc_lemm_grams.append(exceptions_dict[tri])
-            i += 3      
-        elif bi in exceptions_dict:
-            doc_lemm_grams.append(exceptions_dict[bi])
-            i += 2
-        elif uni in exceptions_dict:
-            doc_lemm_grams.append(exceptions_dict[uni])
-            i += 1
-        elif tri in trigrams:
-            doc_lemm_grams.append(tri)
-            i += 3
-        elif bi in bigrams:
-            doc_lemm_grams.append(bi)
-            i += 2
-        else:
-            if uni not in stop_after:
-                doc_lemm_grams.append(uni)
-            i += 1
-    return doc_lemm_grams
-
-
-def find_ngrams(docs, custom_stop = None, stop_exceptions = []):
+    matcher = ngrams if isinstance(ngrams, NgramMatcher) else NgramMatcher(ngrams)
+    return matcher.merge(doc_lemm, stop_after)
+
+
+def find_ngrams(docs, custom_stop = None, stop_exceptions = [], n_jobs=1, min_count=1, max_size=None):
     '''
     Finds ngrams and their frequencies in the corpus.
+
+    Each document is tokenized and counted in one pass, so the tokenized
+    corpus is never held in memory. With n_jobs > 1 the corpus is split into
+    shards counted in parallel and merged. N-grams seen fewer than min_count
+    times are dropped; max_size bounds memory as described in NgramCounter.
     '''
     stopwords = get_stopwords(custom_stop, stop_exceptions)
-    
-    docs_tok_lower = [word_tokenize(clean(text).lower()) for text in docs]
-
-    c_bi = Counter()
-    for doc in docs_tok_lower:
-        for bigram in nltk_bigrams(doc):
-            if bigram[0] not in stopwords and bigram[1] not in stopwords:
-                c_bi[bigram] += 1
-    c_tri = Counter()
-    for doc in docs_tok_lower:
-        for trigram in nltk_trigrams(doc):
-            if trigram[0] not in stopwords and trigram[1] not in stopwords and trigram[2] not in stopwords:
-                c_tri[trigram] += 1
-    return c_bi, c_tri
-
-def process_text(text, ngrams={}, custom_stop=None, stop_exceptions=[], stop_after=[]):
+
+    if n_jobs == 1:
+        counter = NgramCounter(stopwords, max_size)
+        for text in docs:
+            counter.add(word_tokenize(clean(text).lower()))
+    else:
+        if n_jobs < 0:
+            n_jobs = os.cpu_count()
+        docs = list(docs)
+        shard_size = max(1, -(-len(docs) // (n_jobs * 4)))
+        shards = [docs[i:i+shard_size] for i in range(0, len(docs), shard_size)]
+
+        counter = NgramCounter(stopwords, max_size)
+        with multiprocessing.Pool(n_jobs, initializer=init_count_worker, initargs=(stopwords, max_size)) as pool:
+            for shard_counter in pool.imap_unordered(count_worker, shards):
+                counter.merge(shard_counter)
+
+    if min_count > 1:
+        counter.prune(min_count)
+    return counter.to_counters()
+
+def init_count_worker(stopwords, max_size):
+    worker_state.update(stopwords=stopwords, max_size=max_size)
+
+def count_worker(texts):
+    counter = NgramCounter(worker_state["stopwords"], worker_state["max_size"])
+    for text in texts:
+        counter.add(word_tokenize(clean(text).lower()))
+    return counter
+
+def process_text(text, ngrams={}, custom_stop=None, stop_exceptions=[], stop_after=[], lemma_cache=None, backend="nltk"):
     '''
     Process a document, given ngrams and stopwords.
     '''
     stopwords = get_stopwords(custom_stop, stop_exceptions)
-    return merge_ngrams(lemmatize_tokens(word_tokenize(clean(text)), stopwords), ngrams, stop_after)
+    if backend == "spacy":
+        doc = registry.get("spacy_en_lemmatizer")(clean(text))
+        return merge_ngrams(lemmatize_spacy(doc, stopwords), ngrams, stop_after)
+    return merge_ngrams(lemmatize_tokens(word_tokenize(clean(text)), stopwords, lemma_cache), ngrams, stop_after)
 
-def process_texts(docs, ngrams={}, custom_stop=None, stop_exceptions=[], stop_after=[]):
+def init_worker(stopwords, matcher, stop_after, lemma_cache):
+    lemma_cache.track_updates()
+    worker_state.update(stopwords=stopwords, matcher=matcher, stop_after=stop_after, lemma_cache=lemma_cache)
+
+def process_worker(item):
+    i, text = item
+    lemma_cache = worker_state["lemma_cache"]
+    processed = process_text(text, worker_state["matcher"], custom_stop=worker_state["stopwords"], stop_after=worker_state["stop_after"], lemma_cache=lemma_cache)
+    return i, processed, lemma_cache.pop_updates()
+
+def process_texts(docs, ngrams={}, custom_stop=None, stop_exceptions=[], stop_after=[], n_jobs=1, chunksize=None, print_every=0, lemma_cache=None, backend="nltk", batch_size=50, cache=None):
     '''
     Process a list of documents, given ngrams and stopwords.
+
+    With n_jobs > 1 (or -1 for every core), documents are spread over a
+    process pool. The stopwords and compiled ngrams are sent to each worker
+    once, and the longest documents are scheduled first in small chunks so
+    that skewed lengths do not leave workers idle. The output is in the same
+    order, and identical to, the serial path.
+
+    Lemmas are memoized in lemma_cache (the process-wide default if None),
+    which can be loaded from and saved to disk between runs with
+    LemmaCache.load and save. Each worker starts from a copy of it, and the
+    lemmas the workers add, and their hit and miss counts, are merged back
+    into it as documents come in.
+
+    With backend="spacy", tokens and lemmas come from spaCy's nlp.pipe in
+    batches of batch_size, with the parser and NER disabled and n_jobs used
+    as n_process; the same stopword removal and ngram merging follow.
+
+    If cache is a ProcessedCache, documents whose text and preprocessing
+    config (stopwords, ngrams, stop_after, backend) were processed before
+    are read from it, and only the rest are processed and then stored.
     '''
     stopwords = get_stopwords(custom_stop, stop_exceptions)
-    return [process_text(text, ngrams, custom_stop=stopwords, stop_after=stop_after) for text in docs]
+    matcher = ngrams if isinstance(ngrams, NgramMatcher) else NgramMatcher(ngrams)
+
+    if cache is not None:
+        docs = list(docs)
+        config_key = ProcessedCache.get_config_key(stopwords, matcher.config, stop_after, backend)
+        keys = [ProcessedCache.get_key(config_key, text) for text in docs]
+        processed = [cache.get(key) for key in keys]
+        missing = [i for i, doc in enumerate(processed) if doc is None]
+        if print_every:
+            print(f"{len(docs) - len(missing)} of {len(docs)} documents cached, processing {len(missing)}")
+
+        new_docs = process_texts([docs[i] for i in missing], matcher, custom_stop=stopwords, stop_after=stop_after, n_jobs=n_jobs, chunksize=chunksize, print_every=print_every, lemma_cache=lemma_cache, backend=backend, batch_size=batch_size)
+        for i, doc in zip(missing, new_docs):
+            processed[i] = doc
+            cache.store(keys[i], doc)
+        cache.evict()
+        if print_every:
+            print(f"processed cache: {cache.stats()}")
+        return processed
+
+    if backend == "spacy":
+        nlp = registry.get("spacy_en_lemmatizer")
+        processed = []
+        for doc in nlp.pipe((clean(text) for text in docs), batch_size=batch_size, n_process=n_jobs if n_jobs > 0 else os.cpu_count()):
+            processed.append(merge_ngrams(lemmatize_spacy(doc, stopwords), matcher, stop_after))
+            if print_every and len(processed) % print_every == 0:
+                print(f"processed {len(processed)} documents")
+        return processed
+    if lemma_cache is None:
+        lemma_cache = default_lemma_cache
+
+    if n_jobs == 1:
+        processed = []
+        for text in docs:
+            if print_every and len(processed) % print_every == 0:
+                print(f"processing document {len(processed)+1}")
+            processed.append(process_text(text, matcher, custom_stop=stopwords, stop_after=stop_after, lemma_cache=lemma_cache))
+        if print_every:
+            print(f"lemma cache: {lemma_cache.stats()}")
+        return processed
+
+    if n_jobs < 0:
+        n_jobs = os.cpu_count()
+    docs = list(docs)
+    if chunksize is None:
+        chunksize = max(1, len(docs) // (n_jobs * 32))
+
+    # longest first, so a long document is not left for last
+    order = sorted(range(len(docs)), key=lambda i: len(docs[i]), reverse=True)
+    processed = [None] * len(docs)
+
+    with multiprocessing.Pool(n_jobs, initializer=init_worker, initargs=(stopwords, matcher, stop_after, lemma_cache)) as pool:
+        items = ((i, docs[i]) for i in order)
+        for done, (i, doc, updates) in enumerate(pool.imap_unordered(process_worker, items, chunksize)):
+            processed[i] = doc
+            lemma_cache.merge(updates)
+            if print_every and (done + 1) % print_every == 0:
+                print(f"processed {done+1}/{len(docs)} documents")
+    if print_every:
+        print(f"lemma cache: {lemma_cache.stats()}")
+    return processed
+
+def compare_backends(docs, ngrams={}, custom_stop=None, stop_exceptions=[], stop_after=[], n_jobs=1, batch_size=50, top_n=20):
+    '''
+    Process {docs} with both backends and report docs/sec for each, how
+    closely the spaCy output matches NLTK's (token overlap and per-document
+    Jaccard similarity of vocabularies), and the tokens that differ most.
+    '''
+    docs = list(docs)
+    outputs = {}
+    docs_per_sec = {}
+    for backend in ("nltk", "spacy"):
+        start = time.perf_counter()
+        outputs[backend] = process_texts(docs, ngrams, custom_stop=custom_stop, stop_exceptions=stop_exceptions, stop_after=stop_after, n_jobs=n_jobs, backend=backend, batch_size=batch_size)
+        docs_per_sec[backend] = len(docs) / (time.perf_counter() - start)
+
+    jaccards = []
+    only_nltk = Counter()
+    only_spacy = Counter()
+    overlap = 0
+    total = 0
+    for nltk_doc, spacy_doc in zip(outputs["nltk"], outputs["spacy"]):
+        nltk_counts, spacy_counts = Counter(nltk_doc), Counter(spacy_doc)
+        overlap += sum((nltk_counts & spacy_counts).values())
+        total += max(len(nltk_doc), len(spacy_doc))
+        only_nltk += nltk_counts - spacy_counts
+        only_spacy += spacy_counts - nltk_counts
+        union = set(nltk_doc) | set(spacy_doc)
+        jaccards.append(len(set(nltk_doc) & set(spacy_doc)) / len(union) if union else 1.0)
+
+    report = {
+        "docs_per_sec": docs_per_sec,
+        "token_agreement": overlap / total if total else 1.0,
+        "mean_jaccard": sum(jaccards) / len(jaccards) if jaccards else 1.0,
+        "only_nltk": only_nltk.most_common(top_n),
+        "only_spacy": only_spacy.most_common(top_n),
+    }
+    print(f"nltk: {docs_per_sec['nltk']:.2f} docs/sec, spacy: {docs_per_sec['spacy']:.2f} docs/sec")
+    print(f"token agreement {report['token_agreement']:.1%}, mean vocabulary jaccard {report['mean_jaccard']:.3f}")
+    return report
 
 def get_stopwords(custom_stop=None, stop_exceptions=[]):
     '''
     Construct a list of stopwords.
     '''
     if not custom_stop:
-        stop_1 = set(nltk_stopwords.words('english'))
-        stop_2 = spacy.load('en_core_web_sm').Defaults.stop_words
-        stopwords = stop_1.union(stop_2)
+        # NLTK's and spaCy's English stopwords, loaded once per process
+        stopwords = set(registry.get("stopwords"))
     else:
         stopwords = custom_stop
 
@@ -0,0 +1,180 @@
+'''
+# Top-k fic recommendations from topic vectors.
+#
+# Andrew Zhou
+#
+# Fics are rows of a unit-normalized document-topic matrix (as in an index
+# bundle), so the cosine similarity of every fic to a user's favorites is a
+# single matrix product, and the best k are picked with argpartition rather
+# than by sorting the whole catalog.
+'''
+
+import time
+import numpy as np
+
+
+def to_vector(topics, num_topics):
+    '''
+    Turn model[bow] output, a list of (topic, weight), into a unit-length
+    dense vector.
+    '''
+    vector = np.zeros(num_topics, dtype=np.float32)
+    for topic, weight in topics:
+        vector[topic] = weight
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def top_k(scores, k):
+    '''
+    Indices of the k highest scores along the last axis, best first.
+    '''
+    k = min(k, scores.shape[-1])
+    if k <= 0:
+        return np.zeros(scores.shape[:-1] + (0,), dtype=np.int64)
+    best = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(scores, best, axis=-1), axis=-1, kind="stable")
+    return np.take_along_axis(best, order, axis=-1)
+
+
+class Recommender():
+    '''
+    Recommends rows of {vectors}, a unit-normalized (n_fics, num_topics)
+    matrix, for a set of favorites given as unit topic vectors (see
+    to_vector). A fic's score is the (weighted) sum of its cosine
+    similarities to the favorites.
+
+    Fics whose {work_ids} the user has already seen can be excluded, and so
+    are fics nearly identical (cosine at least {duplicate_threshold}) to a
+    favorite, which are usually the favorite itself. With diversity > 0,
+    results are re-ranked with maximal marginal relevance, trading score
+    for being unlike the fics already picked.
+
+    For large catalogs, {index} can be a nearest-neighbor index over the
+    same vectors, keyed by row (see util.ann), which is then searched for
+    candidates instead of scoring every fic.
+    '''
+    def __init__(self, vectors, work_ids=None, duplicate_threshold=0.9999, index=None):
+        self.vectors = vectors
+        self.index = index
+        self.work_ids = list(work_ids) if work_ids is not None else list(range(len(vectors)))
+        self.rows = {work_id: row for row, work_id in enumerate(self.work_ids)}
+        self.duplicate_threshold = duplicate_threshold
+
+    def get_query(self, favorites, weights=None):
+        favorites = np.atleast_2d(np.asarray(favorites, dtype=np.float32))
+        weights = np.ones(len(favorites), dtype=np.float32) if weights is None else np.asarray(weights, dtype=np.float32)
+        return favorites, weights
+
+    def select(self, scores, favorites, k, seen=(), query=None):
+        '''
+        The k best rows by {scores} (or, with an index, by inner product with
+        {query}), skipping seen work_ids and near-duplicates of the
+        favorites. Duplicates are only looked for among the best candidates,
+        widening the search if too many of those are dropped, so the cost
+        does not grow with the catalog.
+        '''
+        seen_rows = np.array([self.rows[work_id] for work_id in seen if work_id in self.rows], dtype=np.int64)
+        if scores is not None:
+            scores[seen_rows] = -np.inf
+        n_candidates = k + len(favorites) + len(seen_rows)
+        while True:
+            if self.index is not None:
+                candidates, _ = self.index.search(query, n_candidates)
+                candidates = candidates[~np.isin(candidates, seen_rows)]
+            else:
+                candidates = top_k(scores, n_candidates)
+                candidates = candidates[np.isfinite(scores[candidates])]
+            if self.duplicate_threshold is not None and len(candidates):
+                duplicate = (favorites @ np.asarray(self.vectors[candidates]).T >= self.duplicate_threshold).any(axis=0)
+                candidates = candidates[~duplicate]
+            if len(candidates) >= k or n_candidates >= len(self.vectors):
+                return candidates[:k]
+            n_candidates *= 2
+
+    def score(self, favorites, weights=None):
+        favorites, weights = self.get_query(favorites, weights)
+        return self.vectors @ (weights @ favorites)
+
+    def recommend(self, favorites, top_n=5, weights=None, seen=(), diversity=0.0, pool_size=None):
+        '''
+        Row indices of the top_n fics for one user's favorites, best first.
+        '''
+        favorites, weights = self.get_query(favorites, weights)
+        query = weights @ favorites
+        scores = self.vectors @ query if self.index is None else None
+        if diversity <= 0:
+            return self.select(scores, favorites, top_n, seen, query)
+
+        # re-rank a pool of the best candidates, rather than the catalog
+        pool = self.select(scores, favorites, pool_size or top_n * 10, seen, query)
+        return self.rerank(pool, np.asarray(self.vectors[pool]) @ query, top_n, diversity)
+
+    def rerank(self, pool, scores, top_n, diversity):
+        '''
+        Maximal marginal relevance: repeatedly pick the candidate with the
+        best (1 - diversity) * relevance - diversity * (similarity to the
+        closest fic already picked), with relevance scaled to [0, 1].
+        '''
+        if not len(pool):
+            return pool
+        relevance = scores / scores.max() if scores.max() > 0 else scores
+        pool_vectors = np.asarray(self.vectors[pool])
+        similarity = pool_vectors @ pool_vectors.T
+
+        picked = []
+        closest = np.full(len(pool), -np.inf)
+        available = np.ones(len(pool), dtype=bool)
+        for _ in range(min(top_n, len(pool))):
+            mmr = (1 - diversity) * relevance - diversity * (closest if picked else 0.0)
+            mmr[~available] = -np.inf
+            choice = int(np.argmax(mmr))
+            picked.append(choice)
+            available[choice] = False
+            closest = np.maximum(closest, similarity[choice])
+        return pool[picked]
+
+    def recommend_batch(self, users, top_n=5, weights=None, seen=None, batch_size=256):
+        '''
+        Recommend for many users at once. {users} is a list of favorites
+        arrays, with optional per-user {weights} and {seen} lists. Scores are
+        computed with one matrix product per batch of users. Returns a list
+        of row index arrays, as from recommend.
+        '''
+        results = []
+        for start in range(0, len(users), batch_size):
+            batch = range(start, min(start + batch_size, len(users)))
+            queries = []
+            for i in batch:
+                favorites, user_weights = self.get_query(users[i], weights[i] if weights is not None else None)
+                queries.append(user_weights @ favorites)
+            queries = np.asarray(queries, dtype=np.float32)
+            scores = queries @ self.vectors.T if self.index is None else [None] * len(queries)
+
+            for row, i in enumerate(batch):
+                favorites, _ = self.get_query(users[i])
+                results.append(self.select(scores[row], favorites, top_n, seen[i] if seen is not None else (), queries[row]))
+        return results
+
+
+def benchmark_recommend(n_fics=100000, num_topics=12, n_favorites=5, n_queries=1000, top_n=5, seed=0):
+    '''
+    Time single and batched recommendations on random topic vectors, in
+    milliseconds per query.
+    '''
+    rng = np.random.default_rng(seed)
+    vectors = rng.dirichlet(np.full(num_topics, 0.3), n_fics).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    recommender = Recommender(vectors)
+    users = [vectors[rng.integers(0, n_fics, n_favorites)] for _ in range(n_queries)]
+
+    start = time.perf_counter()
+    for favorites in users:
+        recommender.recommend(favorites, top_n)
+    single = (time.perf_counter() - start) / n_queries * 1000
+
+    start = time.perf_counter()
+    recommender.recommend_batch(users, top_n)
+    batched = (time.perf_counter() - start) / n_queries * 1000
+
+    print(f"{n_fics} fics: {single:.3f} ms per query, {batched:.3f} ms per query batched")
+    return {"single_ms": single, "batched_ms": batched}
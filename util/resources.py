@@ -0,0 +1,106 @@
+'''
+# Process-wide registry of heavy NLP resources (spaCy pipelines, NLTK
+# lemmatizer and stopwords, VADER), each loaded lazily and exactly once.
+#
+# Andrew Zhou
+'''
+
+import threading
+import time
+
+
+class ResourceRegistry():
+    '''
+    Thread-safe registry of lazily loaded resources. Each resource is built by
+    its loader on first use and shared by every caller after that.
+    '''
+    def __init__(self):
+        self.loaders = {}
+        self.resources = {}
+        self.locks = {}
+        self.load_times = {}
+        self.uses = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, loader):
+        with self.lock:
+            self.loaders[name] = loader
+            self.locks[name] = threading.Lock()
+            self.uses[name] = 0
+
+    def get(self, name):
+        '''
+        Return the named resource, loading it if this is the first use.
+        '''
+        resource = self.resources.get(name)
+        if resource is None:
+            with self.locks[name]:
+                resource = self.resources.get(name)
+                if resource is None:
+                    start = time.perf_counter()
+                    resource = self.loaders[name]()
+                    self.load_times[name] = time.perf_counter() - start
+                    self.resources[name] = resource
+        # += is a read and a write, so concurrent callers could lose counts
+        with self.lock:
+            self.uses[name] += 1
+        return resource
+
+    def warm_up(self, names=None):
+        '''
+        Load the given resources (all registered ones by default) now, e.g. at
+        app startup, so the first request does not pay for it.
+        '''
+        for name in names if names is not None else list(self.loaders):
+            self.get(name)
+
+    def metrics(self):
+        '''
+        Whether each resource is loaded, how long loading took, and how many
+        times it has been requested.
+        '''
+        with self.lock:
+            uses = dict(self.uses)
+        return {name: {"loaded": name in self.resources, "load_time": self.load_times.get(name), "uses": uses[name]} for name in self.loaders}
+
+
+def load_stopwords():
+    from nltk.corpus import stopwords as nltk_stopwords
+    from spacy.lang.en.stop_words import STOP_WORDS
+    return frozenset(set(nltk_stopwords.words('english')).union(STOP_WORDS))
+
+def load_lemmatizer():
+    from nltk.stem import WordNetLemmatizer
+    lemmatizer = WordNetLemmatizer()
+    # WordNet itself is loaded on first use, which is not thread-safe
+    lemmatizer.lemmatize("warming")
+    return lemmatizer
+
+def load_pos_tagger():
+    from nltk.tag.perceptron import PerceptronTagger
+    return PerceptronTagger()
+
+def load_spacy():
+    import spacy
+    return spacy.load('en_core_web_sm')
+
+def load_spacy_lemmatizer():
+    import spacy
+    # only the tagger and lemmatizer are needed to produce lemmas
+    nlp = spacy.load('en_core_web_sm', disable=["parser", "ner"])
+    # without the parser, whole fics fit comfortably in memory
+    nlp.max_length = 10000000
+    return nlp
+
+def load_vader():
+    from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+    return SentimentIntensityAnalyzer()
+
+
+registry = ResourceRegistry()
+registry.register("stopwords", load_stopwords)
+registry.register("wordnet_lemmatizer", load_lemmatizer)
+registry.register("pos_tagger", load_pos_tagger)
+registry.register("spacy_en", load_spacy)
+registry.register("spacy_en_lemmatizer", load_spacy_lemmatizer)
+registry.register("vader", load_vader)
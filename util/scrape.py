@@ -7,23 +7,33 @@ Archive of Our Own (https://archiveofourown.org/), also known as AO3.
 """
 
 from bs4 import BeautifulSoup
-import requests
 import re
 import string
 import time
 import pandas as pd
 import numpy as np
-from collections import defaultdict
+from collections import OrderedDict, deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from util.fetch import Fetcher
 
+# Seconds between requests to AO3; the default rate limit is 1/sleep per second.
 sleep = 5
 
+# Point this at a local stand-in server to test the scraper offline.
+base_url = "https://archiveofourown.org"
+
 
 def get_search_mod(mod, value):
     return f"&work_search[{mod}]={value}"
 
-def get_search_url(fandom, min_kudos=0, complete=True, single_only=False, crossover=False, english_only=True):
+def get_search_url(fandom, min_kudos=0, complete=True, single_only=False, crossover=False, english_only=True, sort_column="created_at"):
+    '''
+    URL of an AO3 work search, newest first by {sort_column}: "created_at"
+    for when works were posted, or "revised_at" for when they last changed.
+    '''
 
-    base_url = "https://archiveofourown.org/works/search?utf8=✓"
+    search_url = base_url + "/works/search?utf8=✓"
 
     params = {}
 
@@ -33,48 +43,143 @@ def get_search_url(fandom, min_kudos=0, complete=True, single_only=False, crosso
     single_chapter = ("single_chapter", 1 if single_only else "")
     language = ("language_id", "en" if english_only else "")
     kudos = ("kudos_count", f">{min_kudos}")
-    sort_by = ("sort_column", "created_at")
+    sort_by = ("sort_column", sort_column)
     sort_order = ("sort_direction", "desc")
 
     params = [complete, crossover, fandom, single_chapter, language, kudos, sort_by, sort_order]
 
-    return base_url + ''.join([get_search_mod(*param) for param in params])
+    return search_url + ''.join([get_search_mod(*param) for param in params])
+
 
+def get_fetcher(workers=1, rate=None, cache=None, max_rate=None, min_rate=None):
+    '''
+    Build a pooled fetcher starting at {rate} requests per second (1/sleep by
+    default), optionally backed by a ResponseCache. The rate adapts between
+    {min_rate} and {max_rate}, as in AdaptiveThrottle, and by default never
+    goes above its starting rate.
+    '''
+    return Fetcher(rate=rate if rate else 1/sleep, pool_size=workers, cache=cache, max_rate=max_rate, min_rate=min_rate)
 
-def get_works_info(search_url, count, page=1, single_only=False, word_range=(0,0), include_adult=False, exclude_series=True, print_every=5):
+
+class WorkSearch():
+    '''
+    Iterates over the works matching an AO3 search, fetching one results page
+    at a time, so only a single page is held in memory.
+
+    The cursor records the page and the work_id of the last work yielded (or,
+    once scrape_fic_list starts calling complete, the last work scraped); a
+    crashed crawl resumes by passing that cursor back in. New works shift
+    results down while we page, so on resuming, up to {resume_pages} pages
+    after the cursor's are searched for its work.
+    '''
+    def __init__(self, search_url, single_only=False, word_range=(0,0), include_adult=False, exclude_series=True, cursor=None, print_every=5, fetcher=None, backend="bs4", resume_pages=5):
+        self.search_url = search_url
+        self.backend = backend
+        self.single_only = single_only
+        self.word_range = word_range
+        self.include_adult = include_adult
+        self.exclude_series = exclude_series
+        self.print_every = print_every
+        self.fetcher = fetcher if fetcher is not None else get_fetcher()
+        self.cursor = dict(cursor) if cursor else {"page": 1, "work_id": None}
+        self.resume_pages = resume_pages
+        self.num_found = None
+        # work_id -> page of works yielded but not yet completed, once the
+        # cursor only advances on complete
+        self.in_flight = None
+
+    def iter_pages(self):
+        '''
+        Yield (page, work_info) for each page of results, unfiltered, starting
+        after the cursor.
+        '''
+        page = self.cursor["page"]
+        resume_after = self.cursor["work_id"]
+        # pages read while looking for resume_after further on
+        held = []
+
+        while True:
+            url_page = self.search_url if page == 1 else self.search_url + "&page=" + str(page)
+
+            html = self.fetcher.get(url_page)
+            num_found, work_info = parse_list_page(html, self.backend)
+
+            if page == 1 and self.num_found is None:
+                self.num_found = num_found
+                print(f"{self.num_found} potential matches found")
+
+            if self.print_every and page % self.print_every == 1:
+                print(f"getting page {page}")
+
+            if not work_info:
+                break
+
+            if resume_after is not None:
+                # new works shift results down, so skip up to the last work we saw
+                work_ids = [info["work_id"] for info in work_info]
+                if resume_after in work_ids:
+                    held = []
+                    work_info = work_info[work_ids.index(resume_after)+1:]
+                    resume_after = None
+                elif len(held) < self.resume_pages:
+                    held.append((page, work_info))
+                    page += 1
+                    continue
+                else:
+                    # not found, so start over from the cursor's page
+                    resume_after = None
+
+            yield from held
+            held = []
+            yield page, work_info
+            page += 1
+
+        yield from held
+
+    def __iter__(self):
+        for page, work_info in self.iter_pages():
+            for info in work_info:
+                if self.in_flight is None:
+                    self.cursor = {"page": page, "work_id": info["work_id"]}
+                if match_conditions(info, self.single_only, self.word_range, self.include_adult, self.exclude_series):
+                    if self.in_flight is not None:
+                        self.in_flight[info["work_id"]] = page
+                    yield info
+
+    def track_completion(self):
+        '''
+        From now on, only advance the cursor past works passed to complete.
+        '''
+        if self.in_flight is None:
+            self.in_flight = OrderedDict()
+
+    def complete(self, work_id):
+        '''
+        Mark a yielded work, and every work yielded before it, as done.
+        '''
+        if work_id not in self.in_flight:
+            return
+        while True:
+            done, page = self.in_flight.popitem(last=False)
+            if done == work_id:
+                self.cursor = {"page": page, "work_id": work_id}
+                return
+
+
+def get_works_info(search_url, count, page=1, single_only=False, word_range=(0,0), include_adult=False, exclude_series=True, print_every=5, fetcher=None, backend="bs4"):
     '''
     Given the URL of an AO3 search query, extracts the work ID and data for
     the first {count} works.
     '''
-    
+    search = WorkSearch(search_url, single_only=single_only, word_range=word_range, include_adult=include_adult, exclude_series=exclude_series, cursor={"page": page, "work_id": None}, print_every=print_every, fetcher=fetcher, backend=backend)
 
-    url_page = search_url if page == 1 else search_url + "&page=" + str(page)
-
-    r = requests.get(url_page, headers="")
-    html = r.text
-    soup = BeautifulSoup(html, 'html.parser')
-    info_list = soup.find_all(class_="blurb")
+    work_info = list(islice(search, count))
 
-    if page == 1:
-        num_found_html = soup.find(text=re.compile(r'\d+ Found'))
-        num_found = re.match('(\d+) Found', str(num_found_html)).groups()[0]
-        print(f"{num_found} potential matches found")
-        
-    if page % print_every == 1:
-        print(f"getting page {page}, {count} works left")
-    
-    if not info_list:
-        print(f"ran out of fics with {count} left")
-        return []
-    work_info = [parse_meta_list(info_html) for info_html in info_list]
-    
-    work_info = [x for x in work_info if match_conditions(x, single_only, word_range, include_adult, exclude_series)]
-
-    if count <= len(work_info):
+    if len(work_info) < count:
+        print(f"ran out of fics with {count - len(work_info)} left")
+    else:
         print("finished")
-        return work_info[:count]
-    time.sleep(sleep)
-    return work_info + get_works_info(search_url, count-len(work_info), page+1, single_only=single_only, word_range=word_range)
+    return work_info
 
 def match_conditions(info, single_only, word_range, include_adult, exclude_series):
     if info["lang"] != "English":
@@ -125,14 +230,31 @@ def chap_html_to_str(chap_html):
     str_arr = [st for st in str_arr if st]
     return ' '.join(str_arr)
 
-def scrape_fic(work_id, as_pd_series=True, no_text=False):
+def parse_list_page(html, backend="bs4"):
     '''
-    Scrape information for a single fanfiction, optionally returning as dict or Series.
+    Parse a page of search results, returning the "N Found" count and the
+    metadata of every work on the page.
     '''
-    url = 'http://archiveofourown.org/works/' + str(work_id) + "?view_full_work=true?view_adult=true"
+    if backend == "lxml":
+        from util import parse_lxml
+        return parse_lxml.parse_list_page(html)
+
+    soup = BeautifulSoup(html, 'html.parser')
+
+    num_found_html = soup.find(text=re.compile(r'\d+ Found'))
+    num_found = re.match('(\d+) Found', str(num_found_html)).groups()[0] if num_found_html else None
+
+    info_list = soup.find_all(class_="blurb")
+    return num_found, [parse_meta_list(info_html) for info_html in info_list]
+
+def parse_fic_page(html, no_text=False, backend="bs4"):
+    '''
+    Parse the full-work page of a fanfiction into a dict.
+    '''
+    if backend == "lxml":
+        from util import parse_lxml
+        return parse_lxml.parse_fic_page(html, no_text)
 
-    r = requests.get(url)
-    html = r.text
     soup = BeautifulSoup(html, 'html.parser')
 
     title = soup.find(class_="title").text.strip()
@@ -155,7 +277,19 @@ def scrape_fic(work_id, as_pd_series=True, no_text=False):
     meta_html = soup.find(class_="meta")
     meta_info = parse_meta_fic(meta_html)
     
-    full_dict = {"title": title, "text": chaps_clean, "author": author, "all_authors": all_authors, **meta_info}
+    return {"title": title, "text": chaps_clean, "author": author, "all_authors": all_authors, **meta_info}
+
+def scrape_fic(work_id, as_pd_series=True, no_text=False, fetcher=None, backend="bs4"):
+    '''
+    Scrape information for a single fanfiction, optionally returning as dict or Series.
+    '''
+    if fetcher is None:
+        fetcher = get_fetcher()
+
+    url = base_url + '/works/' + str(work_id) + "?view_full_work=true?view_adult=true"
+
+    html = fetcher.get(url)
+    full_dict = parse_fic_page(html, no_text, backend)
 
     return pd.Series(full_dict) if as_pd_series else full_dict
 
@@ -189,68 +323,173 @@ def parse_meta_fic(meta_html):
     return {"relationships": reln_tags, "chars": char_tags, "tags": addl_tags, "series": series}
 
 
-def scrape_fic_list(info_list, partial_df = None, print_every=0):
+def scrape_concurrently(info_list, fetcher, workers=1, no_text=False, backend="bs4"):
+    '''
+    Scrape fics from {info_list} on a pool of {workers} threads, yielding
+    (fic_info, future) pairs in input order. Only a small window of fics is
+    in flight at a time.
+    '''
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+    try:
+        for fic_info in info_list:
+            future = executor.submit(scrape_fic, fic_info["work_id"], as_pd_series=False, no_text=no_text, fetcher=fetcher, backend=backend)
+            pending.append((fic_info, future))
+            if len(pending) > 2 * workers:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def scrape_fic_list(info_list, partial_df = None, print_every=0, workers=1, fetcher=None, backend="bs4", journal=None, dead_letter=None, max_consecutive_failures=10, max_rate=None, min_rate=None):
     '''
     Scrapes a list of fanfictions based on information from get_works_info.
     If interrupted, returns a partial result. Can be resumed by passing in that
     partial result on a subsequent call.
+
+    Works are fetched by {workers} threads sharing one pooled, rate-limited
+    fetcher; the rows keep the order of {info_list}. Pages are parsed with
+    {backend}, either "bs4" or the faster "lxml". {info_list} may also be a
+    lazy iterable such as a WorkSearch, in which case later search pages are
+    fetched while earlier works are being scraped.
+
+    Given a ScrapeJournal, each work is written to disk as soon as it is
+    scraped instead of being held in memory, works already in the journal are
+    skipped, and the result is compacted from the journal at the end.
+
+    Works that still fail after the fetcher's retries are added to
+    {dead_letter} (if given) as {"work_id", "error"} dicts and the scrape moves
+    on; it only stops after {max_consecutive_failures} failures in a row.
+
+    Without a {fetcher}, a WorkSearch's own fetcher is used, so the search
+    and the scrape share one rate limit for the host; otherwise one is built
+    with its adaptive rate bounded by {max_rate} and {min_rate}.
+
+    A WorkSearch's cursor is only advanced past works that have been scraped
+    (or failed), not the ones still in flight, so after a crash or an
+    interrupt it resumes the crawl without skipping any.
     '''
     if print_every:
         print("beginning scrape...")
-    
+
+    search = info_list if isinstance(info_list, WorkSearch) else None
+    if search is not None:
+        search.track_completion()
+
+    if fetcher is None:
+        if search is not None:
+            fetcher = search.fetcher
+        else:
+            fetcher = get_fetcher(workers, max_rate=max_rate, min_rate=min_rate)
+
+    total = len(info_list) if hasattr(info_list, "__len__") else "?"
     count = 0
     skipped = 0
+    failed = 0
+    consecutive_failures = 0
         
-    partial_scrape = []
+    partial_scrape = set()
     if type(partial_df) == pd.DataFrame:
-        partial_scrape = partial_df["work_id"].values
-     
-    # assume we pass in at least one element
-    info_keys = list(info_list[0].keys())
-    full_dict = defaultdict(list)
-    
-    for fic_info in info_list:
-        try:
-            if fic_info["work_id"] in partial_scrape:
+        partial_scrape = set(partial_df["work_id"].values)
+
+    def to_scrape():
+        nonlocal skipped
+        for fic_info in info_list:
+            if fic_info["work_id"] in partial_scrape or (journal is not None and fic_info["work_id"] in journal):
                 skipped += 1
                 continue
+            yield fic_info
+
+    rows = []
+
+    try:
+        for fic_info, future in scrape_concurrently(to_scrape(), fetcher, workers, backend=backend):
+            try:
+                fic_dict = future.result()
+            except Exception as e:
+                failed += 1
+                consecutive_failures += 1
+                print(f"Error scraping work {fic_info['work_id']}: {e}")
+                if dead_letter is not None:
+                    dead_letter.append({"work_id": fic_info["work_id"], "error": repr(e)})
+                if search is not None:
+                    search.complete(fic_info["work_id"])
+                if consecutive_failures >= max_consecutive_failures:
+                    print(f"{consecutive_failures} failures in a row, ending scrape at {count}/{total} works processed")
+                    break
+                continue
+            consecutive_failures = 0
 
             if print_every and count % print_every == 0:
-                print(f"scraping fic {count+1}/{len(info_list)}")
-
-            fic_dict = scrape_fic(fic_info["work_id"], as_pd_series=False)
+                metrics = fetcher.metrics()
+                delay = max(metrics["delay"].values(), default=0)
+                print(f"scraping fic {count+1}/{total} ({metrics['requests_per_sec']:.2f} req/s, {metrics['error_rate']:.0%} errors, {delay:.1f}s delay)")
 
-            
-            for key, value in fic_info.items():
-                full_dict[key].append(value)
-            
             # handle potential overlaps depending on how much info we pass in
+            row = dict(fic_info)
             for key, value in fic_dict.items():
-                if key not in info_keys:
-                    full_dict[key].append(value)
+                if key not in fic_info:
+                    row[key] = value
+            if journal is not None:
+                journal.append(row)
+            else:
+                rows.append(row)
+            if search is not None:
+                search.complete(fic_info["work_id"])
             count += 1
+    except KeyboardInterrupt:
+        # rows are only appended once complete, so there is nothing to trim
+        print("Scraping interrupted")
 
-            time.sleep(sleep)
-        except Exception as e:
-            # should be no exception in dict appending
-            print(f"Error encountered, ending scrape at {count}/{len(info_list)} works processed")
-            print(e)
-            break
-        except KeyboardInterrupt:
-            print("Scraping interrupted")
-            num_scraped = count - skipped
-            for key, value in full_dict.items():
-                this_length = len(value)
-                if this_length != num_scraped:
-                    print("Last fic data incomplete, attempted to correct but should examined")
-                    # should have one extra element from the interrupt during appending to full_dict 
-                    # if not, serious error
-                    assert(this_length == num_scraped+1)
-                    full_dict[key] = value[:-1]
-            break
-
-    full_df = pd.DataFrame.from_dict(full_dict)
+    if print_every and skipped:
+        print(f"skipped {skipped} works already scraped")
+    if failed:
+        print(f"{failed} works failed to scrape")
+
+    full_df = journal.compact() if journal is not None else pd.DataFrame(rows)
     if type(partial_df) == pd.DataFrame:
         full_df = pd.concat([partial_df, full_df], ignore_index=True)
             
-    return full_df
\ No newline at end of file
+    return full_df
+
+
+def time_parser(pages, kind, backend):
+    '''
+    Parse {pages} with one backend, returning pages/sec, the peak resident
+    memory added while parsing (MB), and the parsed dicts.
+    '''
+    # Unix-only, so not needed just to scrape
+    import resource
+
+    parse = parse_fic_page if kind == "fic" else parse_list_page
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    parsed = [parse(html, backend=backend) for html in pages]
+    elapsed = time.perf_counter() - start
+
+    peak_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss) / 1024
+    return len(pages) / elapsed, peak_mb, parsed
+
+def benchmark_parsers(pages, kind="fic", backends=("bs4", "lxml")):
+    '''
+    Benchmark the parser backends over saved pages (full-work pages if {kind}
+    is "fic", search result pages otherwise). Each backend runs in a fresh
+    process so peak memory is measured independently, and the outputs are
+    checked against the first backend.
+    '''
+    import multiprocessing
+
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    reference = None
+    for backend in backends:
+        with ctx.Pool(1) as pool:
+            pages_per_sec, peak_mb, parsed = pool.apply(time_parser, (pages, kind, backend))
+        if reference is None:
+            reference = parsed
+        results[backend] = {"pages_per_sec": pages_per_sec, "peak_mb": peak_mb, "identical": parsed == reference}
+        print(f"{backend}: {pages_per_sec:.2f} pages/sec, {peak_mb:.1f} MB peak, identical output: {parsed == reference}")
+    return results